@@ -5,19 +5,35 @@ import shutil
 import re
 from pathlib import Path
 from difflib import SequenceMatcher
-import customtkinter as ctk
-from tkinter import filedialog, messagebox
 from PIL import Image
 import threading
 import logging
 from datetime import datetime
-from xml.dom import minidom
 import zipfile
+import sqlite3
+import sys
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, FIRST_COMPLETED, wait
+import multiprocessing
+import argparse
+import json
+import signal
+from urllib.parse import urlsplit
+import tempfile
+import time
+import hashlib
 import io
-
-# Configuration
-ctk.set_appearance_mode("Dark")
-ctk.set_default_color_theme("blue")
+import functools
+import mmap
+from contextlib import contextmanager
+import zlib
+import itertools
+import fnmatch
+import ctypes
+import select
+import struct
 
 # Platform mapping dictionary
 # The structure for this is the following:
@@ -56,52 +72,3414 @@ PLATFORM_MAPPING = {
 
 SCAN_EXTENSIONS = {'.zip', '.sfc', '.smc', '.sgd', '.smd', '.sms', '.nes', '.gb', '.gbc', '.iso', '.cue', '.chd', '.gba', '.n64', '.nds', '.rvz'}
 
-class GameOrganizerApp(ctk.CTk):
-    def __init__(self):
-        super().__init__()
+# How many levels of subfolders of a platform folder are searched for ROMs,
+# 0 only reads the platform folder itself. Folders named images and hidden
+# folders are never searched. ROMs in subfolders get paths like ./USA/Game.sfc.
+DISCOVERY_DEPTH = 0
+
+# Metadata download
+# The LaunchBox database is fetched as Metadata.zip. Metadata.json next to
+# Metadata.xml remembers the HTTP validators of the last download (for
+# conditional requests and resuming) and the metadata version, a hash of
+# Metadata.xml that everything derived from it is keyed on.
+
+METADATA_URL = "https://gamesdb.launchbox-app.com/Metadata.zip"
+
+# Metadata index
+# Metadata.xml is compiled once into an SQLite file next to it so later scans don't
+# have to parse the whole XML. Bump this version whenever the schema or
+# clean_game_name changes so old indexes get rebuilt.
+
+METADATA_INDEX_VERSION = 6
+
+# Metadata.xml tag -> GameRecord attribute, for the fields add_game_to_xml uses
+GAME_FIELDS = {
+    "DatabaseID": "database_id",
+    "Name": "name",
+    "Platform": "platform",
+    "Overview": "overview",
+    "ReleaseDate": "release_date",
+    "Developer": "developer",
+    "Publisher": "publisher",
+    "Genres": "genres",
+    "MinPlayers": "min_players",
+    "MaxPlayers": "max_players",
+    "CommunityRating": "community_rating",
+}
+
+# Artwork downloaded for each game: (LaunchBox image Type, gamelist.xml tag).
+# If a game has no "Screenshot - Gameplay", its first other screenshot is used.
+ARTWORK_TYPES = [
+    ("Screenshot - Gameplay", "image"),
+    ("Clear Logo", "marquee"),
+    ("Box - Front", "thumbnail")
+]
+
+# Order in which queued artwork is downloaded, lowest first: box art, which
+# frontends show in game lists, then screenshots, then marquees
+ARTWORK_PRIORITY = {"thumbnail": 0, "image": 1, "marquee": 2}
+
+def add_artwork_image(artwork, image_type, file_name):
+    """Record one GameImage in a game's tag -> (Type, FileName) artwork map
+    
+    Images must be added in Metadata.xml order: the first image of each type
+    wins, and the first other screenshot only fills in until a gameplay one shows up.
+    """
+    for artwork_type, tag in ARTWORK_TYPES:
+        if image_type == artwork_type:
+            current = artwork.get(tag)
+            if current is None or current[0] != artwork_type:
+                artwork[tag] = (image_type, file_name)
+            return
+    if "Screenshot" in image_type and "image" not in artwork:
+        artwork["image"] = (image_type, file_name)
+
+# gamelist.xml fields that refresh mode rewrites on existing entries. Entries
+# we add carry the LaunchBox DatabaseID in their id attribute, so they can be
+# refreshed without matching the ROM again.
+GAMELIST_SOURCE = "LaunchBox"
+REFRESH_FIELDS = {"name", "desc", "rating", "releasedate", "developer", "publisher", "genre", "players"}
+
+# Where LaunchBox serves the files named in GameImage/FileName
+IMAGE_BASE_URL = "https://images.launchbox-app.com/"
+# Bytes read from a response at a time, and so between bandwidth limit checks
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Image post-processing
+# Every downloaded image is converted to PNG (the gamelist.xml paths end in
+# .png) and scaled down to fit the device profile: gamelist.xml tag ->
+# (max width, max height), None meaning no limit. Images are never enlarged.
+
+DEVICE_PROFILES = {
+    # Only marquees are limited, as RetroScraper has always done
+    "default": {"marquee": (400, None)},
+    # 640x480 handhelds such as ArkOS devices (RG351, R36S, RGB10)
+    "640x480": {"image": (640, 480), "marquee": (400, 160), "thumbnail": (320, 480)},
+    "720x720": {"image": (720, 720), "marquee": (480, 200), "thumbnail": (360, 540)},
+    "1280x720": {"image": (1280, 720), "marquee": (640, 240), "thumbnail": (480, 720)},
+}
+DEFAULT_DEVICE_PROFILE = "default"
+# zlib level for the PNGs written; above 6 files barely shrink but encoding gets much slower
+PNG_COMPRESS_LEVEL = 6
+
+# Converted artwork is kept in an ArtworkCache folder next to Metadata.xml,
+# shared by every platform folder and library scanned on this machine.
+ARTWORK_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Minimum similarity score for a fuzzy match
+MATCH_THRESHOLD = 0.7
+
+# ROM identification
+# No-Intro/Redump style DAT files (Logiqx XML) in a DATs folder next to
+# Metadata.xml map ROM hashes to canonical titles. A ROM whose hash is found
+# is matched by that title instead of its file name.
+
+DAT_EXTENSIONS = {'.dat', '.xml'}
+HASH_CHUNK_SIZE = 1024 * 1024
+# Compressed disc images: the DATs list the hashes of the original tracks, which
+# the container's own hash never matches, so these are not hashed at all
+UNHASHED_EXTENSIONS = {'.chd', '.cso', '.rvz'}
+
+# Multi-disc games
+# Files whose names only differ by a disc tag, e.g. "(Disc 1 of 2)", are one
+# game: matched once, sharing one set of artwork named after the title
+# without the tag. Optionally an .m3u playlist of the discs is written and
+# added to gamelist.xml instead of the separate discs.
+
+DISC_TAG = re.compile(r'\s*[\(\[](?:disc|disk|cd)(?:\s*(\d+)|\s+([a-d]))(?:\s*of\s*\d+)?[\)\]]', re.IGNORECASE)
+
+def split_disc_tag(stem):
+    """Return (stem without its disc tag, disc) for a file name stem; disc is None if there is no tag"""
+    tag = DISC_TAG.search(stem)
+    if tag is None:
+        return stem, None
+    return (stem[:tag.start()] + stem[tag.end():]).strip(), (tag.group(1) or tag.group(2)).lower()
+
+def group_games(games):
+    """Group a platform's ROM paths by folder and title
+    
+    Returns [(title stem, [paths])] in the order titles first appear, each
+    group's files ordered by disc. A file without a disc tag is a group of its
+    own, together with same-named files in other formats (game.cue, game.chd).
+    Files in different subfolders are never grouped.
+    """
+    groups = {}
+    for game_file in games:
+        title_stem, disc = split_disc_tag(game_file.stem)
+        groups.setdefault((game_file.parent, title_stem), []).append((disc, game_file))
+    
+    def disc_order(item):
+        disc = item[0]
+        if disc is None:
+            return 0, 0, ""
+        return (1, int(disc), "") if disc.isdigit() else (2, 0, disc)
+    
+    return [(title_stem, [game_file for _, game_file in sorted(members, key=disc_order)])
+            for (_, title_stem), members in groups.items()]
+
+def disc_count(group_files):
+    return len({split_disc_tag(game_file.stem)[1] for game_file in group_files} - {None})
+
+# Incremental rescans
+# After each platform is processed, the name, size, mtime and inode of its ROMs
+# are saved to this file in the platform folder. Incremental scans compare the
+# folder against it and only process ROMs that were added or changed since.
+
+SNAPSHOT_FILE = "Scan_Snapshot.json"
+SNAPSHOT_VERSION = 1
+
+# Exclusion list
+# ROMs nothing matched are listed in this file in their platform folder and
+# skipped by later scans, until a metadata update changes the names their
+# platform is matched against. See ExclusionStore.
+
+EXCLUSION_FILE = "Excluded_From_Scan.txt"
+
+def clean_game_name(name):
+    # Remove common tags and formatting from game names
+    patterns = [
+        r'\([^)]*\)',  # Remove anything in parentheses
+        r'\[[^\]]*\]',  # Remove anything in brackets
+        r'\.',          # Remove dots
+        r'\-',          # Remove hyphens
+        r'\_',          # Remove underscores
+        r'\s+',         # Replace multiple spaces with single space
+    ]
+    
+    cleaned = name
+    for pattern in patterns:
+        cleaned = re.sub(pattern, ' ', cleaned)
+    
+    # Remove common words that might differ between filename and metadata
+    common_words = ['usa', 'europe', 'japan', 'english', 'rev', 'version', 'disk', 'disc']
+    words = cleaned.split()
+    filtered_words = [word for word in words if word.lower() not in common_words]
+    
+    return ' '.join(filtered_words).strip()
+
+def candidates_fingerprint(clean_names):
+    """Return a short hash of the distinct cleaned names a platform's ROMs are matched against
+    
+    It only changes when a metadata update adds, removes or renames a candidate,
+    which is when ROMs excluded on that platform are worth trying again.
+    """
+    digest = hashlib.sha1()
+    for name in sorted(set(clean_names)):
+        digest.update(name.encode("utf-8") + b"\n")
+    return digest.hexdigest()[:16]
+
+def similarity(a, b):
+    return SequenceMatcher(None, a, b).ratio()
+
+# Short fields that repeat across thousands of games, stored interned so every
+# record shares a single copy of e.g. "Capcom" or "Sega Genesis"
+INTERNED_FIELDS = {"platform", "developer", "publisher", "genres", "min_players", "max_players"}
+
+class GameRecord:
+    """The metadata fields of one LaunchBox game"""
+    __slots__ = tuple(GAME_FIELDS.values()) + ("clean_name",)
+    
+    def __init__(self, **fields):
+        for attr in GAME_FIELDS.values():
+            setattr(self, attr, fields.get(attr))
+        # Lowercased clean_game_name of the name, used for matching
+        self.clean_name = fields.get("clean_name")
+    
+    @classmethod
+    def from_element(cls, game_elem):
+        """Build a record from a <Game> element, reading only the fields we use"""
+        fields = {}
+        for child in game_elem:
+            attr = GAME_FIELDS.get(child.tag)
+            if attr and child.text:
+                text = child.text
+                fields[attr] = sys.intern(text) if attr in INTERNED_FIELDS else text
+        if fields.get("name"):
+            fields["clean_name"] = clean_game_name(fields["name"]).lower()
+        return cls(**fields)
+
+class MetadataUpdater:
+    """Keeps Metadata.xml in sync with the LaunchBox Metadata.zip
+    
+    The archive is streamed to Metadata.zip.part in chunks. An interrupted
+    transfer resumes with a Range request (If-Range protects against the file
+    having changed meanwhile), and once Metadata.xml exists every check is a
+    conditional request, so an unchanged database costs one round trip.
+    """
+    
+    CHUNK_SIZE = 64 * 1024
+    
+    def __init__(self, xml_path, url=METADATA_URL, timeout=60):
+        self.xml_path = Path(xml_path)
+        self.url = url
+        self.timeout = timeout
+        self.part_path = self.xml_path.with_suffix(".zip.part")
+        self.state_path = self.xml_path.with_suffix(".json")
+    
+    def load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def save_state(self, state):
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+    
+    def version(self):
+        """Return the metadata version of the current Metadata.xml
         
-        self.title("RetroScraper")
-        self.geometry("900x700")
+        The hash is only recomputed when the file's size or mtime no longer match
+        the ones it was recorded with, e.g. after replacing Metadata.xml by hand.
+        """
+        state = self.load_state()
+        stat = self.xml_path.stat()
+        if (state.get("version") and state.get("xml_size") == stat.st_size and
+                state.get("xml_mtime_ns") == stat.st_mtime_ns):
+            return state["version"]
         
-        # Variables
-        self.scan_folder = ctk.StringVar()
-        self.scanning = False
-        self.progress_value = ctk.DoubleVar(value=0)
-        self.status_text = ctk.StringVar(value="Ready to scan")
-        self.platform_status = ctk.StringVar(value="No platform being scanned")
+        digest = hashlib.sha1()
+        with open(self.xml_path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                digest.update(chunk)
+        state.update(version=digest.hexdigest(), xml_size=stat.st_size, xml_mtime_ns=stat.st_mtime_ns)
+        try:
+            self.save_state(state)
+        except OSError:
+            # Read-only folder, the hash just gets recomputed next time
+            pass
+        return state["version"]
+    
+    def update(self, progress=None):
+        """Download Metadata.zip if it changed and extract Metadata.xml from it
+        
+        progress is called with (bytes_received, total_bytes or None). Returns
+        True if Metadata.xml changed. Raises on network or archive errors; a
+        partial download is kept so the next call can resume it.
+        """
+        state = self.load_state()
+        headers = {}
+        offset = self.part_path.stat().st_size if self.part_path.exists() else 0
+        partial = state.get("partial") or {}
+        resume_validator = partial.get("etag") or partial.get("last_modified")
+        
+        if offset and resume_validator:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = resume_validator
+        else:
+            offset = 0
+            if self.xml_path.exists():
+                if state.get("etag"):
+                    headers["If-None-Match"] = state["etag"]
+                if state.get("last_modified"):
+                    headers["If-Modified-Since"] = state["last_modified"]
+        
+        with requests.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                return False
+            if response.status_code == 416:
+                # The partial file is no use for the current archive, start over
+                self.part_path.unlink(missing_ok=True)
+                state.pop("partial", None)
+                self.save_state(state)
+                return self.update(progress)
+            response.raise_for_status()
+            
+            if response.status_code != 206:
+                offset = 0
+            total = response.headers.get("Content-Length")
+            total = int(total) + offset if total else None
+            
+            # Remember what is being downloaded before writing, so an interrupted
+            # transfer can be resumed
+            state["partial"] = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            self.save_state(state)
+            
+            received = offset
+            with open(self.part_path, "ab" if offset else "wb") as f:
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progress:
+                        progress(received, total)
+        
+        try:
+            changed = self.extract(state)
+        except zipfile.BadZipFile:
+            # Corrupt or truncated archive, don't try to resume it
+            self.part_path.unlink(missing_ok=True)
+            state.pop("partial", None)
+            self.save_state(state)
+            raise
+        
+        partial = state.pop("partial")
+        state["etag"] = partial["etag"]
+        state["last_modified"] = partial["last_modified"]
+        self.save_state(state)
+        self.part_path.unlink()
+        return changed
+    
+    def extract(self, state):
+        """Extract Metadata.xml from the downloaded archive if its content changed"""
+        digest = hashlib.sha1()
+        tmp_path = self.xml_path.with_name(self.xml_path.name + ".tmp")
+        with zipfile.ZipFile(self.part_path) as zip_file:
+            with zip_file.open("Metadata.xml") as source, open(tmp_path, "wb") as target:
+                for chunk in iter(lambda: source.read(self.CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    target.write(chunk)
+        
+        version = digest.hexdigest()
+        if self.xml_path.exists() and state.get("version") == version:
+            # Same content, keep the old file so nothing derived from it is rebuilt
+            tmp_path.unlink()
+            return False
+        
+        os.replace(tmp_path, self.xml_path)
+        stat = self.xml_path.stat()
+        state.update(version=version, xml_size=stat.st_size, xml_mtime_ns=stat.st_mtime_ns)
+        return True
+
+class MetadataIndex:
+    """SQLite index compiled from Metadata.xml
+    
+    Games are keyed by platform and cleaned lowercase name, images by DatabaseID
+    and Type. Rows keep the order they had in Metadata.xml so lookups return the
+    same game the old tree walks did.
+    """
+    
+    GAME_COLUMNS = ["seq", "clean_name"] + list(GAME_FIELDS.values())
+    
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+    
+    def close(self):
+        self.conn.close()
+    
+    @classmethod
+    def is_current(cls, db_path, metadata_version):
+        """Return True if db_path was compiled from this metadata version"""
+        db_path = Path(db_path)
+        if not db_path.exists():
+            return False
+        try:
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                info = dict(conn.execute("SELECT key, value FROM meta"))
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return False
+        
+        return (info.get("index_version") == str(METADATA_INDEX_VERSION) and
+                info.get("metadata_version") == metadata_version)
+    
+    @classmethod
+    def compile(cls, xml_path, db_path, metadata_version, progress=None):
+        """Stream Metadata.xml into a fresh index at db_path
+        
+        The index is built in a temporary file and renamed into place, so an
+        interrupted compile never leaves a half-written index behind.
+        """
+        xml_path = Path(xml_path)
+        db_path = Path(db_path)
+        tmp_path = db_path.with_name(db_path.name + ".tmp")
+        if tmp_path.exists():
+            tmp_path.unlink()
+        
+        game_columns = cls.GAME_COLUMNS
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(f"CREATE TABLE games ({', '.join(c + (' INTEGER PRIMARY KEY' if c == 'seq' else ' TEXT') for c in game_columns)})")
+            conn.execute("CREATE TABLE images (seq INTEGER PRIMARY KEY, database_id TEXT, type TEXT, file_name TEXT)")
+            conn.execute("CREATE TABLE alternate_names (seq INTEGER PRIMARY KEY, database_id TEXT, clean_name TEXT)")
+            
+            insert_game = f"INSERT INTO games VALUES ({', '.join('?' * len(game_columns))})"
+            insert_image = "INSERT INTO images VALUES (?, ?, ?, ?)"
+            insert_alternate_name = "INSERT INTO alternate_names VALUES (?, ?, ?)"
+            games, images, alternate_names = [], [], []
+            game_count = image_count = alternate_name_count = 0
+            
+            for tag, elem in iter_metadata_elements(xml_path):
+                if tag == "Game":
+                    record = GameRecord.from_element(elem)
+                    if record.name:
+                        game_count += 1
+                        games.append([game_count] + [getattr(record, c) for c in game_columns[1:]])
+                elif tag == "GameImage":
+                    file_name = elem.findtext("FileName")
+                    if file_name:
+                        image_count += 1
+                        images.append((image_count, elem.findtext("DatabaseID"), elem.findtext("Type"), file_name))
+                elif tag == "GameAlternateName":
+                    clean_name = clean_game_name(elem.findtext("AlternateName") or "").lower()
+                    if clean_name:
+                        alternate_name_count += 1
+                        alternate_names.append((alternate_name_count, elem.findtext("DatabaseID"), clean_name))
+                
+                if len(games) >= 5000:
+                    conn.executemany(insert_game, games)
+                    games.clear()
+                    if progress:
+                        progress(game_count, image_count)
+                if len(images) >= 5000:
+                    conn.executemany(insert_image, images)
+                    images.clear()
+                if len(alternate_names) >= 5000:
+                    conn.executemany(insert_alternate_name, alternate_names)
+                    alternate_names.clear()
+            
+            conn.executemany(insert_game, games)
+            conn.executemany(insert_image, images)
+            conn.executemany(insert_alternate_name, alternate_names)
+            
+            # Build the lookup indexes after the bulk insert, it is much faster
+            conn.execute("CREATE INDEX games_platform_name ON games (platform, clean_name)")
+            conn.execute("CREATE INDEX games_database_id ON games (database_id)")
+            conn.execute("CREATE INDEX images_game_type ON images (database_id, type)")
+            conn.execute("CREATE INDEX alternate_names_database_id ON alternate_names (database_id)")
+            
+            conn.execute("CREATE TABLE platforms (platform TEXT PRIMARY KEY, fingerprint TEXT)")
+            rows = conn.execute(
+                "SELECT platform, clean_name FROM games UNION "
+                "SELECT games.platform, alternate_names.clean_name FROM alternate_names "
+                "JOIN games ON games.database_id = alternate_names.database_id ORDER BY 1")
+            conn.executemany("INSERT INTO platforms VALUES (?, ?)", [
+                (platform, candidates_fingerprint(clean_name for _, clean_name in platform_rows))
+                for platform, platform_rows in itertools.groupby(rows.fetchall(), key=lambda row: row[0])])
+            
+            # Resolve each game's artwork once, screenshot fallback included.
+            # SQLite returns the other columns of the MIN(seq) row, i.e. the first image.
+            conn.execute("CREATE TABLE artwork (database_id TEXT, tag TEXT, type TEXT, file_name TEXT, PRIMARY KEY (database_id, tag))")
+            for image_type, tag in ARTWORK_TYPES:
+                conn.execute(
+                    "INSERT INTO artwork SELECT database_id, ?, type, file_name FROM "
+                    "(SELECT database_id, type, file_name, MIN(seq) FROM images WHERE type = ? GROUP BY database_id)",
+                    (tag, image_type))
+            conn.execute(
+                "INSERT OR IGNORE INTO artwork SELECT database_id, 'image', type, file_name FROM "
+                "(SELECT database_id, type, file_name, MIN(seq) FROM images WHERE instr(type, 'Screenshot') > 0 GROUP BY database_id)")
+            
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ("index_version", str(METADATA_INDEX_VERSION)),
+                ("metadata_version", metadata_version),
+                ("game_count", str(game_count)),
+                ("image_count", str(image_count)),
+                ("alternate_name_count", str(alternate_name_count)),
+            ])
+            conn.commit()
+        except BaseException:
+            conn.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        conn.close()
+        
+        os.replace(tmp_path, db_path)
+        return game_count, image_count
+    
+    def _record(self, row):
+        return GameRecord(**dict(zip(self.GAME_COLUMNS, row)))
+    
+    def games_for_platform(self, platform):
+        """Yield every game on platform in Metadata.xml order"""
+        cursor = self.conn.execute(
+            f"SELECT {', '.join(self.GAME_COLUMNS)} FROM games WHERE platform = ? ORDER BY seq",
+            (platform,))
+        for row in cursor:
+            yield self._record(row)
+    
+    def alternate_names_for_platform(self, platform):
+        """Yield (cleaned alternate name, game) for every alternate name of a game on platform
+        
+        In the order of the games in Metadata.xml, then of their names.
+        """
+        columns = ', '.join(f"games.{column}" for column in self.GAME_COLUMNS)
+        cursor = self.conn.execute(
+            f"SELECT alternate_names.clean_name, {columns} FROM alternate_names "
+            "JOIN games ON games.database_id = alternate_names.database_id "
+            "WHERE games.platform = ? ORDER BY games.seq, alternate_names.seq",
+            (platform,))
+        for row in cursor:
+            yield row[0], self._record(row[1:])
+    
+    def game_by_id(self, database_id):
+        """Return the game with the given DatabaseID, or None"""
+        row = self.conn.execute(
+            f"SELECT {', '.join(self.GAME_COLUMNS)} FROM games WHERE database_id = ? ORDER BY seq LIMIT 1",
+            (database_id,)).fetchone()
+        return self._record(row) if row else None
+    
+    def artwork_for_game(self, database_id):
+        """Return a game's gamelist.xml tag -> (Type, FileName) artwork map"""
+        rows = self.conn.execute(
+            "SELECT tag, type, file_name FROM artwork WHERE database_id = ?",
+            (database_id,))
+        return {tag: (image_type, file_name) for tag, image_type, file_name in rows}
+    
+    def platform_fingerprint(self, platform):
+        """Return the candidates_fingerprint of a platform, None if it has no games"""
+        row = self.conn.execute("SELECT fingerprint FROM platforms WHERE platform = ?", (platform,)).fetchone()
+        return row[0] if row else None
+
+class XmlMetadata:
+    """Metadata.xml streamed into compact in-memory records
+    
+    Only used when the SQLite index can't be compiled, e.g. on a read-only drive.
+    Games on platforms missing from PLATFORM_MAPPING are dropped while loading,
+    and so are their images.
+    """
+    
+    def __init__(self, xml_path, platforms=None):
+        if platforms is None:
+            platforms = set(PLATFORM_MAPPING.values())
+        
+        self.games = {}   # platform -> [GameRecord] in Metadata.xml order
+        self.games_by_id = {}
+        self.artwork = {}  # DatabaseID -> {tag: (Type, FileName)}, see add_artwork_image
+        self.alternate_names = {}  # DatabaseID -> [cleaned alternate names]
+        self.fingerprints = {}  # platform -> candidates_fingerprint, see platform_fingerprint
+        skipped_ids = set()
+        
+        for tag, elem in iter_metadata_elements(xml_path):
+            if tag == "Game":
+                record = None
+                if elem.findtext("Platform") in platforms:
+                    record = GameRecord.from_element(elem)
+                if record is not None and record.name:
+                    self.games.setdefault(record.platform, []).append(record)
+                    if record.database_id:
+                        self.games_by_id.setdefault(record.database_id, record)
+                else:
+                    db_id = elem.findtext("DatabaseID")
+                    if db_id:
+                        skipped_ids.add(db_id)
+            elif tag == "GameImage":
+                file_name = elem.findtext("FileName")
+                db_id = elem.findtext("DatabaseID")
+                # Images are normally listed after all games, but keep images of
+                # games not seen yet until the end in case a file is ordered differently
+                image_type = elem.findtext("Type")
+                if file_name and db_id and image_type and db_id not in skipped_ids:
+                    add_artwork_image(self.artwork.setdefault(sys.intern(db_id), {}), sys.intern(image_type), file_name)
+            elif tag == "GameAlternateName":
+                clean_name = clean_game_name(elem.findtext("AlternateName") or "").lower()
+                db_id = elem.findtext("DatabaseID")
+                if clean_name and db_id and db_id not in skipped_ids:
+                    self.alternate_names.setdefault(db_id, []).append(clean_name)
+        
+        for db_id in [db_id for db_id in self.artwork if db_id not in self.games_by_id]:
+            del self.artwork[db_id]
+        for db_id in [db_id for db_id in self.alternate_names if db_id not in self.games_by_id]:
+            del self.alternate_names[db_id]
+    
+    def close(self):
+        self.games = {}
+        self.games_by_id = {}
+        self.artwork = {}
+        self.alternate_names = {}
+        self.fingerprints = {}
+    
+    def games_for_platform(self, platform):
+        return iter(self.games.get(platform, ()))
+    
+    def alternate_names_for_platform(self, platform):
+        for game in self.games.get(platform, ()):
+            for clean_name in self.alternate_names.get(game.database_id, ()):
+                yield clean_name, game
+    
+    def game_by_id(self, database_id):
+        return self.games_by_id.get(database_id)
+    
+    def artwork_for_game(self, database_id):
+        return self.artwork.get(database_id, {})
+    
+    def platform_fingerprint(self, platform):
+        # Asked for on every miss, so computed once per platform like the index's platforms table
+        if platform not in self.fingerprints:
+            games = self.games.get(platform)
+            self.fingerprints[platform] = candidates_fingerprint(
+                [game.clean_name for game in games] +
+                [clean_name for clean_name, _ in self.alternate_names_for_platform(platform)]) if games else None
+        return self.fingerprints[platform]
+
+class MatchCache:
+    """Remembers which game each ROM matched, so repeat scans skip matching
+    
+    Entries map (metadata platform, ROM key) to (DatabaseID, score, exact),
+    DatabaseID being None for ROMs nothing matched. The ROM key is the cleaned
+    lowercase name the ROM was matched by, its DAT title if it was identified
+    by hash. The cache is emptied whenever the metadata version or the
+    matching code (METADATA_INDEX_VERSION) changes.
+    """
+    
+    def __init__(self, db_path, metadata_version):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS matches (platform TEXT, rom_key TEXT, database_id TEXT, "
+                          "score REAL, exact INTEGER, PRIMARY KEY (platform, rom_key))")
+        
+        cache_version = f"{metadata_version}:{METADATA_INDEX_VERSION}"
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'cache_version'").fetchone()
+        if row is None or row[0] != cache_version:
+            self.conn.execute("DELETE FROM matches")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('cache_version', ?)", (cache_version,))
+        self.conn.commit()
+    
+    def get(self, platform, rom_key):
+        """Return the cached (database_id, score, exact), or None if the ROM was never matched"""
+        row = self.conn.execute("SELECT database_id, score, exact FROM matches WHERE platform = ? AND rom_key = ?",
+                                (platform, rom_key)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], bool(row[2])
+    
+    def put(self, platform, rom_key, database_id, score, exact):
+        self.conn.execute("INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?)",
+                          (platform, rom_key, database_id, score, int(exact)))
+    
+    def commit(self):
+        self.conn.commit()
+    
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+class ExclusionStore:
+    """A platform folder's exclusion list, the ROMs nothing matched
+    
+    One line per ROM: its file name, then tab separated the metadata version it
+    was last tried with, its platform's candidates_fingerprint at the time and
+    the best score it got. Lines holding just a file name, from older versions
+    or added by hand, are still read. Deleting a line has the ROM scanned again.
+    Changes are only written by flush().
+    """
+    
+    HEADER = "# File name, metadata version, candidates fingerprint, best score. Delete a line to scan that file again.\n"
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}  # file name -> (metadata version, fingerprint, best score), None if unknown
+        self.retry = set()  # names excluded with other candidates, tried again this scan
+        self.dirty = False
+        self.writable = True
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, name):
+        return name in self.entries and name not in self.retry
+    
+    def load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                fields = line.rstrip("\r\n").split("\t")
+                name = fields[0].strip()
+                if not name:  # Skip empty lines
+                    continue
+                version, fingerprint, score = (fields[1:] + ["", "", ""])[:3]
+                try:
+                    score = float(score)
+                except ValueError:
+                    score = None
+                self.entries[name] = (version or None, fingerprint or None, score)
+    
+    def add(self, name, metadata_version, fingerprint, score):
+        self.entries[name] = (metadata_version, fingerprint, score)
+        self.retry.discard(name)
+        self.dirty = True
+    
+    def remove(self, name):
+        if self.entries.pop(name, None) is not None:
+            self.dirty = True
+        self.retry.discard(name)
+    
+    def flush(self):
+        """Write the list if it changed, replacing the old file in one step"""
+        if not self.dirty or not self.writable:
+            return
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.HEADER)
+            for name, (version, fingerprint, score) in self.entries.items():
+                if version is None:
+                    f.write(f"{name}\n")
+                else:
+                    f.write(f"{name}\t{version}\t{fingerprint or ''}\t{'' if score is None else f'{score:.3f}'}\n")
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+class PlatformIndex:
+    """Match candidates for one metadata platform, built once per scan
+    
+    Metadata names are cleaned and lowercased up front. Exact hits are a dict
+    lookup, by a game's name or one of its alternate names (regional titles
+    and the like); only misses are scored against this platform's game names.
+    """
+    
+    def __init__(self, platform, games, alternate_names=()):
+        self.platform = platform
+        # Cleaned name -> first game with that name. Later games with the same
+        # cleaned name could never win a match, so they are not kept.
+        self.names = {}
+        for game in games:
+            if game.clean_name not in self.names:
+                self.names[game.clean_name] = game
+        self.candidates = list(self.names.values())
+        # Alternate names are exact hits only, and never hide a game's own name
+        for clean_name, game in alternate_names:
+            if clean_name not in self.names:
+                self.names[clean_name] = game
+        self.fuzzy_matcher = None
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def match(self, lookup_name):
+        """Return (game, score, exact) for a cleaned lowercase ROM name
+        
+        game is None if nothing scores above MATCH_THRESHOLD, score is then the
+        best one seen (see FuzzyMatcher.best_match).
+        """
+        game = self.names.get(lookup_name)
+        if game is not None:
+            return game, 1.0, True
+        
+        # Only built on the first miss, platforms that only see exact hits never pay for it
+        if self.fuzzy_matcher is None:
+            self.fuzzy_matcher = FuzzyMatcher([game.clean_name for game in self.candidates])
+        
+        position, best_score = self.fuzzy_matcher.best_match(lookup_name)
+        best_match = self.candidates[position] if position is not None else None
+        return best_match, best_score, False
+
+class FuzzyMatcher:
+    """Finds the candidate name with the highest similarity() to a query
+    
+    Gives exactly the result of scoring every candidate in order and keeping the
+    first one with the highest score above the threshold, but only runs the full
+    SequenceMatcher on candidates that can still beat the current best:
+    
+    - candidates sharing the most character trigrams with the query are scored
+      first, so a strong best is found early
+    - every other candidate is first checked against two cheap upper bounds of
+      ratio(): the length bound of real_quick_ratio() and the character count
+      bound of quick_ratio()
+    """
+    
+    def __init__(self, names):
+        self.names = names
+        
+        # Candidate positions sorted by name length, for the length window
+        self.by_length = sorted(range(len(names)), key=lambda i: len(names[i]))
+        self.lengths = [len(names[i]) for i in self.by_length]
+        
+        # Trigram -> positions of the candidates containing it
+        self.trigrams = {}
+        for position, name in enumerate(names):
+            for gram in self.name_trigrams(name):
+                self.trigrams.setdefault(gram, []).append(position)
+    
+    @staticmethod
+    def name_trigrams(name):
+        padded = f"  {name} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    def best_match(self, query, threshold=MATCH_THRESHOLD):
+        """Return (position, score) of the best candidate
+        
+        If none scores above threshold, position is None and score the best
+        ratio seen. Candidates that could not reach the threshold are never
+        scored, so that is only the best of the ones that were (0 if none).
+        """
+        names = self.names
+        query_length = len(query)
+        query_counts = Counter(query).items()
+        best_position = None
+        best_score = 0
+        best_seen = 0
+        
+        def can_win(bound, position):
+            # ratio() never exceeds its bounds, so a candidate whose bound can't beat
+            # the threshold, or the best so far (ties go to the earlier candidate), can be skipped
+            if bound <= threshold:
+                return False
+            return bound > best_score or (bound == best_score and position < best_position)
+        
+        def score(position):
+            nonlocal best_position, best_score, best_seen
+            name = names[position]
+            total_length = query_length + len(name)
+            if total_length:
+                if not can_win(2.0 * min(query_length, len(name)) / total_length, position):
+                    return
+                matches = sum(min(count, name.count(char)) for char, count in query_counts)
+                if not can_win(2.0 * matches / total_length, position):
+                    return
+            ratio = similarity(query, name)
+            best_seen = max(best_seen, ratio)
+            if ratio > threshold and (ratio > best_score or (ratio == best_score and position < best_position)):
+                best_position = position
+                best_score = ratio
+        
+        # Most promising candidates first
+        shared = Counter()
+        for gram in self.name_trigrams(query):
+            shared.update(self.trigrams.get(gram, ()))
+        for position, _ in shared.most_common():
+            score(position)
+        
+        # Then everything else whose length can still reach the threshold
+        low = query_length * threshold / (2 - threshold)
+        high = query_length * (2 - threshold) / threshold
+        start = bisect_left(self.lengths, low)
+        end = bisect_right(self.lengths, high)
+        for position in self.by_length[start:end]:
+            if position not in shared:
+                score(position)
+        
+        if best_position is None:
+            return None, best_seen
+        return best_position, best_score
+
+def iter_metadata_elements(xml_path):
+    """Stream the top-level elements of Metadata.xml as (tag, element) pairs
+    
+    Each element is cleared once the caller is done with it, so memory use
+    stays flat no matter how large the file is.
+    """
+    context = ET.iterparse(xml_path, events=("start", "end"))
+    depth = 0
+    root = None
+    for event, elem in context:
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        
+        depth -= 1
+        if depth == 1:
+            yield elem.tag, elem
+            elem.clear()
+            root.clear()
+
+class DatIndex:
+    """Canonical titles of every ROM listed in a folder of DAT files
+    
+    ROMs are looked up by SHA1, or by (size, CRC32) when no SHA1 is known,
+    e.g. for zipped ROMs whose CRC32 comes from the zip directory.
+    """
+    
+    def __init__(self, dat_folder):
+        self.by_sha1 = {}
+        self.by_crc = {}
+        self.dat_count = 0
+        for dat_file in sorted(Path(dat_folder).iterdir()):
+            if dat_file.is_file() and dat_file.suffix.lower() in DAT_EXTENSIONS:
+                self.load(dat_file)
+                self.dat_count += 1
+    
+    def __len__(self):
+        return len(self.by_crc) + len(self.by_sha1)
+    
+    def load(self, dat_file):
+        # <game> in No-Intro/Redump DATs, <machine> in MAME ones
+        for _, elem in ET.iterparse(dat_file):
+            if elem.tag not in ("game", "machine"):
+                continue
+            title = elem.get("name")
+            if title:
+                for rom in elem.iter("rom"):
+                    sha1 = rom.get("sha1")
+                    if sha1:
+                        self.by_sha1.setdefault(sha1.lower(), title)
+                    crc, size = rom.get("crc"), rom.get("size")
+                    if crc and size and size.isdigit():
+                        self.by_crc.setdefault((int(size), crc.lower()), title)
+            elem.clear()
+    
+    def title_for(self, hashes):
+        """Return the canonical title for a ROM's (size, crc32, sha1) hashes, or None"""
+        for size, crc, sha1 in hashes:
+            title = self.by_sha1.get(sha1) if sha1 else None
+            if title is None:
+                title = self.by_crc.get((size, crc))
+            if title is not None:
+                return title
+        return None
+
+def hash_rom(path):
+    """Return a list of (size, crc32, sha1) for a ROM file, hex digests in lowercase
+    
+    Zip files get one entry per member, read from the zip's central directory
+    without decompressing anything; their sha1 is None. Other files are
+    hashed through mmap so large disc images are never read into memory.
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".zip":
+        with zipfile.ZipFile(path) as archive:
+            return [(info.file_size, f"{info.CRC:08x}", None)
+                    for info in archive.infolist() if not info.is_dir()]
+    
+    crc = 0
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        # Empty files can't be mapped
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for start in range(0, size, HASH_CHUNK_SIZE):
+                    chunk = view[start:start + HASH_CHUNK_SIZE]
+                    crc = zlib.crc32(chunk, crc)
+                    sha1.update(chunk)
+                    chunk.release()
+    return [(size, f"{crc:08x}", sha1.hexdigest())]
+
+class DownloadError(Exception):
+    """An image could not be downloaded"""
+
+class IncompleteDownload(requests.ConnectionError):
+    """The connection ended before the whole response body arrived"""
+
+class BandwidthLimiter:
+    """Caps the combined speed of every download at bytes_per_second
+    
+    Threads call throttle() with the bytes they just read and sleep for as
+    long as the downloads are ahead of the cap. Bandwidth left unused for up
+    to a second can be caught up in a burst.
+    """
+    
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+    
+    def throttle(self, size, cancelled):
+        with self.lock:
+            now = time.monotonic()
+            self.next_free = max(self.next_free, now - 1.0) + size / self.bytes_per_second
+            delay = self.next_free - now
+        if delay > 0:
+            cancelled.wait(delay)
+
+class ImageDownloader:
+    """Downloads images concurrently over one pooled requests.Session
+    
+    A bounded pool of worker threads fetches the files, never more than
+    per_host_limit at a time from the same host and, if bandwidth_limit is
+    set, no faster than that many bytes per second overall. Queued files are
+    fetched in priority order. 5xx responses, timeouts, connection errors and
+    bodies shorter than their Content-Length are retried with exponential
+    backoff. Each file is written to a temporary name next to its destination
+    and renamed into place when complete, so an interrupted download never
+    leaves a truncated image behind.
+    """
+    
+    def __init__(self, workers=8, per_host_limit=4, retries=3, backoff=0.5, timeout=30, metrics=None,
+                 bandwidth_limit=0):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+        
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        
+        # Every task on the executor takes the most urgent job off the queue
+        # when it starts, rather than the job it was submitted for
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ImageDownloader")
+        self.jobs = queue.PriorityQueue()  # (priority, order, url, path, process, Future)
+        self.job_order = itertools.count()
+        self.per_host_limit = per_host_limit
+        self.host_slots = {}  # host -> BoundedSemaphore
+        self.pending = set()  # destination paths queued or in progress
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.metrics = metrics or ScanMetrics()
+    
+    def submit(self, url, path, process=None, on_done=None, priority=0):
+        """Queue url to be saved at path
+        
+        process is called with the downloaded bytes and returns the bytes to save.
+        on_done is called with the finished Future, whose result is the path or
+        None if the download was cancelled. Jobs with a lower priority are started
+        first. Returns the Future, or None if path is already queued.
+        """
+        path = Path(path)
+        with self.lock:
+            if path in self.pending:
+                return None
+            self.pending.add(path)
+        
+        future = Future()
+        if on_done:
+            future.add_done_callback(on_done)
+        self.jobs.put((priority, next(self.job_order), url, path, process, future))
+        self.executor.submit(self._run_next)
+        return future
+    
+    def cancel(self):
+        """Drop queued downloads and stop retrying the ones in progress"""
+        self.cancelled.set()
+    
+    def close(self):
+        """Wait for every queued download to finish and release the connections"""
+        self.executor.shutdown(wait=True)
+        self.session.close()
+    
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            slot = self.host_slots.get(host)
+            if slot is None:
+                slot = self.host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return slot
+    
+    def _run_next(self):
+        _, _, url, path, process, future = self.jobs.get_nowait()
+        try:
+            result = self._download(url, path, process)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+    
+    def _download(self, url, path, process):
+        try:
+            if self.cancelled.is_set():
+                return None
+            
+            with self._host_slot(url):
+                data = self._fetch(url)
+                if data is None:
+                    return None
+            self.metrics.inc("downloaded_files")
+            self.metrics.inc("downloaded_bytes", len(data))
+            
+            if process:
+                data = process(data)
+            if self.cancelled.is_set():
+                return None
+            
+            fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as out_file:
+                    out_file.write(data)
+                os.replace(tmp_name, path)
+                self.metrics.inc("written_bytes", len(data))
+            except BaseException:
+                if os.path.exists(tmp_name):
+                    os.unlink(tmp_name)
+                raise
+            return path
+        finally:
+            with self.lock:
+                self.pending.discard(path)
+    
+    def _fetch(self, url):
+        """GET url and return its body, retrying 5xx responses and network errors with exponential backoff"""
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = self.session.get(url, stream=True, timeout=self.timeout)
+                with response:
+                    self.metrics.inc("http_responses", status=str(response.status_code))
+                    if response.status_code == 200:
+                        return self._read(response)
+                if response.status_code < 500 or last_attempt:
+                    raise DownloadError(f"HTTP {response.status_code}")
+            except (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                self.metrics.inc("network_errors", error=type(e).__name__)
+                if last_attempt:
+                    raise
+            
+            # Event.wait doubles as a sleep that ends early when cancelled
+            if self.cancelled.wait(self.backoff * 2 ** attempt):
+                return None
+            self.metrics.inc("download_retries")
+    
+    def _read(self, response):
+        """Read a response body, no faster than the bandwidth limit; None if cancelled meanwhile"""
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            chunks.append(chunk)
+            received += len(chunk)
+            if self.limiter is not None:
+                self.limiter.throttle(len(chunk), self.cancelled)
+            if self.cancelled.is_set():
+                return None
+        
+        # The length of compressed responses is that of the compressed body
+        expected = response.headers.get("Content-Length", "")
+        if expected.isdigit() and received < int(expected) and "Content-Encoding" not in response.headers:
+            raise IncompleteDownload(f"Received {received} of {expected} bytes")
+        return b"".join(chunks)
+
+class DownloadQueue:
+    """Image downloads that haven't finished yet, kept on disk across scans
+    
+    A job (image path, URL, gamelist.xml tag, artwork cache key) is saved when
+    the image is queued and deleted once it is in place, or can't be
+    downloaded at all. Jobs cut short by a cancelled scan, a crash or a
+    network outage stay behind, and the next scan resumes them.
+    """
+    
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # Queued by the hundred per platform: don't wait for the disk on every commit
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, url TEXT, tag TEXT, cache_key TEXT)")
+        self.conn.commit()
+    
+    def add(self, path, url, tag, cache_key):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)", (str(path), url, tag, cache_key))
+            self.conn.commit()
+    
+    def remove(self, path):
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE path = ?", (str(path),))
+            self.conn.commit()
+    
+    def jobs(self):
+        """Return every queued (path, url, tag, cache_key), oldest first"""
+        with self.lock:
+            rows = self.conn.execute("SELECT path, url, tag, cache_key FROM jobs ORDER BY rowid").fetchall()
+        return [(Path(path), url, tag, cache_key) for path, url, tag, cache_key in rows]
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def fit_image_size(size, max_size):
+    """Return size scaled down, keeping its aspect ratio, to fit a (max width, max height) bound"""
+    width, height = size
+    max_width, max_height = max_size
+    scale = 1.0
+    if max_width and width > max_width:
+        scale = max_width / width
+    if max_height and height * scale > max_height:
+        scale = max_height / height
+    if scale == 1.0:
+        return size
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def convert_image(data, max_size=None):
+    """Turn downloaded image bytes into PNG bytes no larger than max_size
+    
+    Runs on the image process pool. Returns (png_bytes, original_size, size).
+    The image is decoded once, in memory; JPEGs that are being scaled down are
+    decoded straight at a reduced scale with Pillow's draft mode. PNGs that
+    already fit are returned untouched. Raises DownloadError if the data is not
+    an image Pillow can read.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            original_size = img.size
+            size = fit_image_size(original_size, max_size) if max_size else original_size
+            if img.format == "PNG" and size == original_size:
+                return data, original_size, size
+            
+            if img.format == "JPEG" and size != original_size:
+                img.draft(img.mode, size)
+            img.load()
+            
+            # PNG can't store CMYK or YCbCr, and palette images can't be resampled
+            if img.mode not in ("RGB", "RGBA", "L", "LA"):
+                has_alpha = img.mode.endswith("A") or "transparency" in img.info
+                img = img.convert("RGBA" if has_alpha else "RGB")
+            if img.size != size:
+                img = img.resize(size, Image.LANCZOS)
+            
+            out = io.BytesIO()
+            img.save(out, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+            return out.getvalue(), original_size, size
+    except Image.UnidentifiedImageError:
+        raise DownloadError("Not a recognized image format")
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise DownloadError(f"Could not decode image: {str(e)}")
+
+def is_complete_image(path):
+    """Whether the file at path is an image Pillow can decode to the end"""
+    try:
+        with Image.open(path) as img:
+            img.load()
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return False
+
+def link_or_copy(src, dest):
+    """Hardlink src to dest, or copy it where hardlinks aren't possible (e.g. across drives)"""
+    dest = Path(dest)
+    tmp_path = dest.with_name(f".{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+class ArtworkCache:
+    """Converted artwork shared by every platform folder and library on a machine
+    
+    Files are stored under a hash of their LaunchBox FileName and the size they
+    were fitted to, so each image crosses the network once per machine. They
+    are hardlinked (or copied) in and out of the cache. Once the cache grows
+    past max_bytes, the least recently used files are deleted; a file's mtime
+    is bumped every time it is used.
+    """
+    
+    def __init__(self, cache_dir, max_bytes=ARTWORK_CACHE_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = sum(size for _, size, _ in self.entries())
+    
+    @staticmethod
+    def key(file_name, max_size):
+        return hashlib.sha1(f"{file_name}|{max_size}".encode("utf-8")).hexdigest()
+    
+    def path_for(self, key):
+        return self.cache_dir / key[:2] / key
+    
+    def entries(self):
+        """Yield (path, size, mtime) of every cached file"""
+        with os.scandir(self.cache_dir) as shards:
+            for shard in shards:
+                if not shard.is_dir():
+                    continue
+                with os.scandir(shard.path) as files:
+                    for entry in files:
+                        if entry.name.startswith("."):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        yield Path(entry.path), stat.st_size, stat.st_mtime
+    
+    def place(self, key, dest):
+        """Put the cached file for key at dest; returns False if it isn't cached"""
+        cached_path = self.path_for(key)
+        try:
+            link_or_copy(cached_path, dest)
+            os.utime(cached_path)
+        except FileNotFoundError:
+            return False
+        return True
+    
+    def add(self, key, src):
+        """Store the file at src under key, evicting old files if the cache is full"""
+        cached_path = self.path_for(key)
+        if cached_path.exists():
+            return
+        cached_path.parent.mkdir(exist_ok=True)
+        link_or_copy(src, cached_path)
+        with self.lock:
+            self.total_bytes += cached_path.stat().st_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+    
+    def evict(self):
+        # Called with the lock held. Shrinks to 90% so a full cache doesn't
+        # rescan the folder on every add.
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                pass
+        self.total_bytes = total
+
+# Worker processes (matching, image conversion) are spawned, not forked: a scan
+# starts them while discovery, download and UI threads are running, and a
+# child forked while another thread holds a lock can deadlock.
+PROCESS_CONTEXT = multiprocessing.get_context("spawn")
+
+# Parallel matching
+# Matching is CPU-bound, so with the SQLite index it is fanned out to a process
+# pool. Each worker opens the index read-only instead of parsing Metadata.xml,
+# and large platforms are split into chunks of this many ROMs.
+
+MATCH_CHUNK_SIZE = 250
+
+_worker_metadata = None
+_worker_cancelled = None
+_worker_platform_indexes = {}
+
+def _init_match_worker(index_path, cancelled):
+    global _worker_metadata, _worker_cancelled
+    _worker_metadata = MetadataIndex(index_path)
+    _worker_cancelled = cancelled
+
+def _match_chunk(metadata_platform, lookups):
+    """Match (rom_name, lookup_name) pairs in a worker process
+    
+    Returns (rom_name, lookup_name, database_id, score, exact) tuples; database_id
+    is None for a miss. Stops early, returning what it has, when the scan is cancelled.
+    """
+    platform_index = _worker_platform_indexes.get(metadata_platform)
+    if platform_index is None:
+        platform_index = PlatformIndex(metadata_platform, _worker_metadata.games_for_platform(metadata_platform),
+                                       _worker_metadata.alternate_names_for_platform(metadata_platform))
+        _worker_platform_indexes[metadata_platform] = platform_index
+    
+    results = []
+    for rom_name, lookup_name in lookups:
+        if _worker_cancelled.is_set():
+            break
+        game, score, exact = platform_index.match(lookup_name)
+        results.append((rom_name, lookup_name, game.database_id if game is not None else None, score, exact))
+    return results
+
+def rom_path(platform_folder, game_file):
+    """Return a ROM's path relative to its platform folder, e.g. USA/Game.sfc
+    
+    This is what ROMs are known by in gamelist.xml (after ./), the exclusion
+    list and the scan snapshot. For ROMs directly in the folder it is the file name.
+    """
+    if game_file.parent == platform_folder:
+        return game_file.name
+    return game_file.relative_to(platform_folder).as_posix()
+
+def list_rom_folder(folder, prefix="", ignore=(), subfolders=False):
+    """List the ROMs in one folder of a platform folder's tree
+    
+    Returns ({ROM path: (size, mtime_ns, inode)}, [(subfolder, its prefix)]),
+    ROM paths being prefix (e.g. "USA/") followed by the file name. Names
+    matching one of the ignore patterns (lowercase fnmatch patterns, compared
+    case insensitively) are skipped. Subfolders are only listed if asked for,
+    never images or hidden folders.
+    
+    Uses os.scandir, so telling files from folders costs no extra stat call
+    on most systems and every ROM is stat'ed exactly once.
+    """
+    listing = {}
+    folders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            name = entry.name
+            if ignore and any(fnmatch.fnmatchcase(name.lower(), pattern) for pattern in ignore):
+                continue
+            if os.path.splitext(name)[1].lower() not in SCAN_EXTENSIONS:
+                try:
+                    if subfolders and name.lower() != "images" and not name.startswith(".") and entry.is_dir():
+                        folders.append((Path(entry.path), f"{prefix}{name}/"))
+                except OSError:
+                    pass
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            listing[prefix + name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    return listing, folders
+
+def list_platform_folders(folder):
+    """Return the subfolders of a ROMs folder that are named in PLATFORM_MAPPING"""
+    with os.scandir(folder) as entries:
+        return [Path(entry.path) for entry in entries
+                if entry.name.lower() in PLATFORM_MAPPING and entry.is_dir()]
+
+class InotifyWatcher:
+    """Reports changes to the files of some folders with Linux inotify, through ctypes
+    
+    inotify only sees changes made by this machine (or, for a network share,
+    by the file server itself), changes made by other clients of a share
+    have to be found by polling.
+    """
+    
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+    
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}  # watch descriptor -> folder
+    
+    def add(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(folder))
+        self.watches[wd] = Path(folder)
+    
+    def read(self, timeout):
+        """Wait up to timeout seconds for events, return them as [(folder, name, mask)]
+        
+        folder is None for a queue overflow, after which anything may have changed.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, "", mask))
+            elif mask & self.IN_IGNORED:
+                # The folder was deleted or unmounted
+                self.watches.pop(wd, None)
+            elif wd in self.watches:
+                events.append((self.watches[wd], name, mask))
+        return events
+    
+    def close(self):
+        os.close(self.fd)
+
+def escape_gamelist_text(text):
+    # The characters minidom escapes, in text and attribute values alike
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def gamelist_text(text):
+    """Escape a text node, with its line breaks read the way an XML parser reads them"""
+    return escape_gamelist_text(text.replace("\r\n", "\n").replace("\r", "\n"))
+
+def gamelist_nodes(elem):
+    """Return an element's children with its text and their tails in between, in document order"""
+    nodes = [elem.text] if elem.text else []
+    for child in elem:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(child.tail)
+    return nodes
+
+def format_gamelist_node(node, indent, out):
+    """Append a node to out, formatted like minidom's toprettyxml(indent="\t")
+    
+    A text node gets a line of its own. An element holding a single text node
+    goes on one line, an empty one is written as <tag/>, and the children of
+    any other element go on their own lines, one tab deeper.
+    """
+    if isinstance(node, str):
+        out.append(f"{indent}{gamelist_text(node)}\n")
+        return
+    
+    nodes = gamelist_nodes(node)
+    out.append(f"{indent}<{node.tag}")
+    for name, value in node.attrib.items():
+        out.append(f' {name}="{escape_gamelist_text(value)}"')
+    if not nodes:
+        out.append("/>\n")
+    elif len(nodes) == 1 and isinstance(nodes[0], str):
+        out.append(f">{gamelist_text(nodes[0])}</{node.tag}>\n")
+    else:
+        out.append(">\n")
+        for child in nodes:
+            format_gamelist_node(child, indent + "\t", out)
+        out.append(f"{indent}</{node.tag}>\n")
+
+def gamelist_chunks(root):
+    """Yield the text of gamelist.xml, one top-level entry at a time
+    
+    The result is byte for byte what the old minidom round trip wrote: the
+    XML declaration, then the tree pretty printed with tabs, leaving out every
+    line that holds only whitespace (e.g. the indentation of a parsed gamelist).
+    """
+    def without_blank_lines(text):
+        return "".join(line + "\n" for line in text.split("\n") if line.strip())
+    
+    yield '<?xml version="1.0"?>\n'
+    nodes = gamelist_nodes(root)
+    if not len(root):
+        out = []
+        format_gamelist_node(root, "", out)
+        yield without_blank_lines("".join(out))
+        return
+    
+    attributes = "".join(f' {name}="{escape_gamelist_text(value)}"' for name, value in root.attrib.items())
+    yield without_blank_lines(f"<{root.tag}{attributes}>\n")
+    for node in nodes:
+        out = []
+        format_gamelist_node(node, "\t", out)
+        yield without_blank_lines("".join(out))
+    yield f"</{root.tag}>\n"
+
+# Log files, scan summaries and the Prometheus textfile go here
+LOG_DIR = Path(__file__).parent / "logs"
+
+def setup_logging(console=True):
+    """Log to a timestamped file in logs/, and to the console if console is set"""
+    # Create logs directory if it doesn't exist
+    log_dir = LOG_DIR
+    log_dir.mkdir(exist_ok=True)
+    
+    # Create log file with timestamp
+    log_file = log_dir / f"log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    
+    handlers = [logging.FileHandler(log_file, encoding='utf-8')]
+    if console:
+        handlers.append(logging.StreamHandler())
+    
+    # Configure logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+    logger = logging.getLogger(__name__)
+    logger.info("Application started")
+    return logger
+
+class ScanMetrics:
+    """Counters and stage timings of one scan, safe to update from any thread
+    
+    Everything is a counter identified by a name and labels, e.g. "matches"
+    with platform="snes" and kind="exact". Time spent in a stage is counted in
+    seconds under "stage_seconds", summed over threads for the stages that run
+    on several at once (image_convert, image_lookup). summary() turns the counters into a JSON
+    friendly dict and write_textfile() into the Prometheus text format.
+    """
+    
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.success = None
+        self.counters = Counter()
+        self.lock = threading.Lock()
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+    
+    @contextmanager
+    def stage(self, stage, **labels):
+        """Count the time spent in the with block as stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+    
+    def finish(self, success):
+        self.finished = time.time()
+        self.success = success
+    
+    def by_label(self, name, label, **filters):
+        """Return {label value: total} of a counter, over the entries matching filters"""
+        totals = {}
+        with self.lock:
+            items = list(self.counters.items())
+        for (counter_name, labels), value in items:
+            labels = dict(labels)
+            if counter_name != name or label not in labels:
+                continue
+            if any(labels.get(key) != wanted for key, wanted in filters.items()):
+                continue
+            totals[labels[label]] = totals.get(labels[label], 0) + value
+        return totals
+    
+    def total(self, name, **filters):
+        with self.lock:
+            items = list(self.counters.items())
+        return sum(value for (counter_name, labels), value in items
+                   if counter_name == name and all(dict(labels).get(key) == wanted for key, wanted in filters.items()))
+    
+    def summary(self):
+        duration = (self.finished or time.time()) - self.started
+        
+        match_kinds = self.by_label("matches", "kind")
+        match_count = sum(match_kinds.values())
+        match_seconds = self.total("stage_seconds", stage="match")
+        
+        caches = {}
+        for cache, results in sorted(self.cache_results().items()):
+            hits, misses = results.get("hit", 0), results.get("miss", 0)
+            caches[cache] = {"hits": hits, "misses": misses,
+                             "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None}
+        
+        platforms = {}
+        for platform, roms in sorted(self.by_label("roms_found", "platform").items()):
+            seconds = self.total("stage_seconds", stage="platform", platform=platform)
+            kinds = self.by_label("matches", "kind", platform=platform)
+            platforms[platform] = {
+                "roms": roms,
+                "seconds": round(seconds, 3),
+                "stages": {stage: round(value, 3) for stage, value in
+                           sorted(self.by_label("stage_seconds", "stage", platform=platform).items())},
+                "matches": {kind: kinds.get(kind, 0) for kind in ("exact", "fuzzy", "miss")},
+            }
+        
+        return {
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "duration_seconds": round(duration, 3),
+            "success": self.success,
+            "stages": {stage: round(value, 3) for stage, value in sorted(self.by_label("stage_seconds", "stage").items())},
+            "matches": {
+                "exact": match_kinds.get("exact", 0),
+                "fuzzy": match_kinds.get("fuzzy", 0),
+                "miss": match_kinds.get("miss", 0),
+                "identified_by_hash": self.total("roms_identified"),
+                "per_second": round(match_count / match_seconds, 1) if match_seconds else None,
+            },
+            "downloads": {
+                "files": self.total("downloaded_files"),
+                "bytes": self.total("downloaded_bytes"),
+                "bytes_written": self.total("written_bytes"),
+                "failed": self.total("download_failures"),
+                "retries": self.total("download_retries"),
+                "resumed": self.total("downloads_resumed"),
+                "http_status": dict(sorted(self.by_label("http_responses", "status").items())),
+                "network_errors": dict(sorted(self.by_label("network_errors", "error").items())),
+            },
+            "caches": caches,
+            "platforms": platforms,
+        }
+    
+    def cache_results(self):
+        results = {}
+        with self.lock:
+            items = list(self.counters.items())
+        for (name, labels), value in items:
+            if name == "cache_requests":
+                labels = dict(labels)
+                cache = results.setdefault(labels["cache"], {})
+                cache[labels["result"]] = cache.get(labels["result"], 0) + value
+        return results
+    
+    def write_textfile(self, path):
+        """Write the counters in Prometheus text format, for node_exporter's textfile collector"""
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        
+        with self.lock:
+            items = sorted(self.counters.items())
+        
+        lines = []
+        for metric, value in (("scan_start_timestamp_seconds", round(self.started, 3)),
+                              ("scan_duration_seconds", round((self.finished or time.time()) - self.started, 6)),
+                              ("scan_success", 1 if self.success else 0)):
+            lines.append(f"# TYPE retroscraper_{metric} gauge")
+            lines.append(f"retroscraper_{metric} {value}")
+        
+        last_name = None
+        for (name, labels), value in items:
+            if name != last_name:
+                lines.append(f"# TYPE retroscraper_{name} gauge")
+                last_name = name
+            label_text = ",".join(f'{key}="{escape(label_value)}"' for key, label_value in labels)
+            value_text = str(round(value, 6))
+            lines.append(f"retroscraper_{name}{{{label_text}}} {value_text}" if label_text else f"retroscraper_{name} {value_text}")
+        
+        # Written under a temporary name so the collector never reads half a file
+        path = Path(path)
+        temp_path = path.with_name(path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+class ScanEngine:
+    """Scans ROM folders, matches games and writes gamelist.xml and artwork
+    
+    Has no GUI dependencies. Progress is reported through log(), set_status(),
+    set_platform_status() and set_progress(), which do nothing here and are
+    overridden by the GUI and the command line front ends.
+    """
+    
+    def __init__(self, scan_path=None, metadata_path=None):
+        self.logger = logging.getLogger(__name__)
+        self.scan_path = Path(scan_path) if scan_path else None
+        self.scanning = False
+        
+        # ROM discovery: subfolder levels searched, fnmatch patterns of file and
+        # folder names to skip, and threads listing folders
+        self.discovery_depth = DISCOVERY_DEPTH
+        self.discovery_ignore = []
+        self.discovery_workers = 4
+        
+        # Keep watching scan_path for new ROMs after the scan, until it is cancelled.
+        # Folders are listed every watch_interval seconds if inotify can't be used
+        # (or watch_polling is set), changes are scanned once files have been
+        # left alone for watch_debounce seconds.
+        self.watch = False
+        self.watch_polling = False
+        self.watch_interval = 30
+        self.watch_debounce = 2
+        
+        # Set metadata path
+        self.metadata_path = Path(metadata_path) if metadata_path else Path(__file__).parent / "Metadata.xml"
+        self.metadata_index_path = self.metadata_path.with_suffix(".db")
+        
+        # Image downloads, capped at download_bandwidth bytes per second overall
+        # (0 for no limit). Unfinished downloads are kept in the download queue
+        # and resumed by the next scan.
+        self.download_workers = 8
+        self.downloads_per_host = 4
+        self.download_bandwidth = 0
+        self.downloader = None
+        self.download_queue_path = self.metadata_path.with_name("DownloadQueue.db")
+        self.download_queue = None
+        
+        # Image conversion and resizing, on a process pool
+        self.device_profile = DEFAULT_DEVICE_PROFILE
+        self.image_workers = os.cpu_count() or 1
+        self.image_pool = None
+        
+        # Artwork shared across platform folders and libraries, 0 disables the cache.
+        # Images already being downloaded are remembered so they are fetched once per scan.
+        self.artwork_cache_path = self.metadata_path.with_name("ArtworkCache")
+        self.artwork_cache_size = ARTWORK_CACHE_SIZE
+        self.artwork_cache = None
+        self.artwork_waiting = {}  # cache key -> [(suffix, image_path)] waiting for its download
+        self.artwork_lock = threading.Lock()
+        
+        # Remember matches across scans
+        self.use_match_cache = True
+        self.match_cache_path = self.metadata_path.with_name("MatchCache.db")
+        self.match_cache = None
+        
+        # Exclusion lists of the platform folders seen this scan, see load_exclusions,
+        # and the gamelist.xml trees read before their platform is processed, see load_gamelist
+        self.exclusion_stores = {}
+        self.gamelists = {}
+        
+        # Identify ROMs by hash against the DAT files in dat_path, if there are any
+        self.dat_path = self.metadata_path.with_name("DATs")
+        self.hash_workers = 4
+        self.dat_index = None
+        self.rom_titles = {}
+        
+        # Check for a newer Metadata.xml before each scan
+        self.update_metadata = True
+        self.metadata_version = None
+        
+        # Update metadata of games already in gamelist.xml instead of skipping them
+        self.refresh_existing = False
+        
+        # Add one .m3u playlist entry for multi-disc games instead of an entry per disc
+        self.generate_playlists = False
+        
+        # Only process ROMs added or changed since the last scan, and whether to
+        # drop the gamelist entries and images of ROMs that were deleted
+        self.incremental = False
+        self.prune_removed = False
+        
+        # Counters and timings of the current (or last) scan, and where they are saved
+        # at the end of it. The summary goes to logs/ unless a path is set.
+        self.metrics = ScanMetrics()
+        self.metrics_summary_path = None
+        self.metrics_textfile_path = LOG_DIR / "RetroScraper.prom"
+        
+        # Processes used to match games, 1 matches on the scan thread
+        self.match_workers = os.cpu_count() or 1
+    
+    def log(self, message):
+        """Show a progress message to the user"""
+    
+    def set_status(self, text):
+        """Show the overall scan status"""
+    
+    def set_platform_status(self, text):
+        """Show which platform is being scanned"""
+    
+    def set_progress(self, value):
+        """Show scan progress, from 0 to 1"""
+    
+    def cancel_downloads(self):
+        """Drop queued image downloads and stop the ones in progress
+        
+        The front ends call this along with clearing scanning, as the scan may
+        already be waiting for its downloads to finish.
+        """
+        downloader = self.downloader
+        if downloader is not None:
+            downloader.cancel()
+    
+    def check_metadata(self):
+        """Make sure Metadata.xml exists and, if update_metadata is set, is up to date"""
+        exists = self.metadata_path.exists()
+        if exists and not self.update_metadata:
+            self.log("Metadata.xml found")
+            self.logger.info("Metadata.xml found")
+            return True
+        
+        if exists:
+            self.log("Checking for metadata updates...")
+            self.logger.info("Checking for metadata updates")
+        else:
+            self.log("Downloading metadata...")
+            self.logger.info("Metadata.xml not found, downloading...")
+        
+        last_report = [0]
+        def report(received, total):
+            # Every 8 MB is plenty for a status line
+            if received - last_report[0] >= 8 * 1024 * 1024:
+                last_report[0] = received
+                size = f"{received // (1024 * 1024)} MB" + (f" / {total // (1024 * 1024)} MB" if total else "")
+                self.set_status(f"Downloading metadata... ({size})")
+        
+        try:
+            if MetadataUpdater(self.metadata_path).update(report):
+                self.log("Metadata.xml downloaded successfully")
+                self.logger.info("Metadata.xml downloaded successfully")
+            else:
+                self.log("Metadata.xml is up to date")
+                self.logger.info("Metadata.xml is up to date")
+            return True
+            
+        except Exception as e:
+            if exists:
+                msg = f"Could not check for metadata updates: {str(e)}. Using the existing Metadata.xml"
+                self.log(msg)
+                self.logger.warning(msg)
+                return True
+            error_msg = f"Failed to download metadata: {str(e)}"
+            self.log(error_msg)
+            self.logger.error(error_msg)
+            return False
+    
+    def load_metadata(self):
+        """Open the metadata index, compiling it from Metadata.xml if it is missing or stale"""
+        self.metadata_version = MetadataUpdater(self.metadata_path).version()
+        try:
+            index_current = MetadataIndex.is_current(self.metadata_index_path, self.metadata_version)
+            self.metrics.inc("cache_requests", cache="metadata_index", result="hit" if index_current else "miss")
+            if not index_current:
+                self.log("Compiling metadata index (one-time, this can take a few minutes)...")
+                self.logger.info(f"Compiling metadata index: {self.metadata_index_path}")
+                
+                def report(game_count, image_count):
+                    self.set_status(f"Compiling metadata index... ({game_count} games, {image_count} images)")
+                
+                game_count, image_count = MetadataIndex.compile(self.metadata_path, self.metadata_index_path,
+                                                                self.metadata_version, report)
+                self.log(f"Metadata index compiled: {game_count} games, {image_count} images")
+                self.logger.info(f"Metadata index compiled: {game_count} games, {image_count} images")
+            
+            return MetadataIndex(self.metadata_index_path)
+        except (sqlite3.Error, OSError) as e:
+            msg = f"Could not use metadata index ({str(e)}), loading Metadata.xml directly"
+            self.log(msg)
+            self.logger.warning(msg)
+            return XmlMetadata(self.metadata_path)
+    
+    def run_scan(self):
+        """Scan scan_path; returns True if the scan completed
+        
+        If it failed, the exception is left in scan_error.
+        """
+        metadata = None
+        completed = False
+        self.scan_error = None
+        self.platform_indexes = {}
+        self.rom_titles = {}
+        self.folder_listings = {}
+        self.exclusion_stores = {}
+        self.gamelists = {}
+        self.metrics = ScanMetrics()
+        try:
+            # Load metadata
+            self.log("Loading metadata file...")
+            self.logger.info("Loading metadata file")
+            with self.metrics.stage("metadata_load"):
+                metadata = self.load_metadata()
+            self.image_pool = ProcessPoolExecutor(max_workers=max(1, self.image_workers), mp_context=PROCESS_CONTEXT)
+            self.downloader = ImageDownloader(workers=self.download_workers, per_host_limit=self.downloads_per_host,
+                                              metrics=self.metrics, bandwidth_limit=self.download_bandwidth)
+            self.artwork_waiting = {}
+            if self.artwork_cache_size > 0:
+                try:
+                    self.artwork_cache = ArtworkCache(self.artwork_cache_path, self.artwork_cache_size)
+                except OSError as e:
+                    msg = f"Could not open the artwork cache ({str(e)}), images will not be cached"
+                    self.log(msg)
+                    self.logger.warning(msg)
+            try:
+                self.download_queue = DownloadQueue(self.download_queue_path)
+            except sqlite3.Error as e:
+                msg = f"Could not open the download queue ({str(e)}), unfinished downloads will not be resumed"
+                self.log(msg)
+                self.logger.warning(msg)
+            else:
+                self.resume_downloads()
+            if self.use_match_cache:
+                self.match_cache = MatchCache(self.match_cache_path, self.metadata_version)
+            
+            # Find all game files
+            self.log("Scanning for game files...")
+            self.logger.info("Scanning for game files")
+            
+            scan_path = self.scan_path
+            
+            # Check if the selected folder is a platform folder itself
+            platform_name = scan_path.name.lower()
+            if platform_name in PLATFORM_MAPPING:
+                # User selected a platform folder directly
+                self.log(f"Scanning platform folder directly: {platform_name}")
+                self.logger.info(f"Scanning platform folder directly: {platform_name}")
+                platform_folders = [scan_path]
+            else:
+                # User selected a folder containing platform subfolders
+                self.log("Scanning for platform subfolders...")
+                self.logger.info("Scanning for platform subfolders")
+                
+                platform_folders = list_platform_folders(scan_path)
+            
+            with self.metrics.stage("identify"):
+                self.dat_index = self.load_dat_index()
+            
+            # Each platform is matched and processed as soon as its folders are listed
+            platforms = self.discover_platforms(platform_folders, metadata)
+            if self.match_workers > 1 and isinstance(metadata, MetadataIndex):
+                platforms = self.match_in_parallel(platforms, metadata)
+            else:
+                platforms = ((platform_folder, games, None) for platform_folder, games in platforms)
+            self.process_platforms(platforms, metadata, len(platform_folders))
+            
+            if self.scanning and not self.folder_listings and not self.watch:
+                self.log("No platform folders or game files found")
+                self.logger.warning("No platform folders or game files found")
+                self.set_status("No platforms found")
+                return False
+            
+            if self.scanning and self.watch:
+                self.watch_for_changes(metadata, platform_folders)
+                self.log(f"Stopped watching {scan_path}")
+                self.logger.info(f"Stopped watching {scan_path}")
+            
+            if self.scanning:
+                self.set_status("Waiting for image downloads...")
+                with self.metrics.stage("download_wait"):
+                    self.downloader.close()
+                self.downloader = None
+            
+            if self.scanning:
+                self.set_status("Scan completed successfully")
+                self.set_platform_status("Scan completed")
+                self.log("Scan completed successfully")
+                self.logger.info("Scan completed successfully")
+                completed = True
+            else:
+                self.log("Scan was cancelled")
+                self.logger.warning("Scan was cancelled")
+                
+        except Exception as e:
+            error_msg = f"Error during scan: {str(e)}"
+            self.log(error_msg)
+            self.set_status("Error occurred")
+            self.set_platform_status("Error occurred")
+            self.logger.exception("Error during scan")
+            self.scan_error = e
+        finally:
+            if self.downloader is not None:
+                self.downloader.cancel()
+                self.downloader.close()
+                self.downloader = None
+            # After the downloader, whose threads may still be waiting on it
+            if self.image_pool is not None:
+                self.image_pool.shutdown(wait=True)
+                self.image_pool = None
+            self.artwork_cache = None
+            if self.download_queue is not None:
+                self.download_queue.close()
+                self.download_queue = None
+            if self.match_cache is not None:
+                self.match_cache.close()
+                self.match_cache = None
+            if metadata is not None:
+                metadata.close()
+            self.platform_indexes = {}
+            self.dat_index = None
+            self.rom_titles = {}
+            self.folder_listings = {}
+            self.exclusion_stores = {}
+            self.gamelists = {}
+            self.metrics.finish(completed)
+            self.write_metrics()
+        
+        self.scanning = False
+        return completed
+    
+    def process_platforms(self, platforms, metadata, total_platforms):
+        """Process the (platform_folder, games, matches) yielded by platforms, saving each one's snapshot"""
+        processed_platforms = 0
+        for platform_folder, games, matches in platforms:
+            if not self.scanning:
+                break
+            
+            platform_name = platform_folder.name.lower()
+            platform_display_name = PLATFORM_MAPPING.get(platform_name, platform_name)
+            self.set_platform_status(f"Scanning: {platform_display_name}")
+            with self.metrics.stage("platform", platform=platform_name):
+                self.process_platform(platform_folder, games, metadata, matches)
+            if self.scanning:
+                self.save_snapshot(platform_folder, self.folder_listings[platform_folder])
+            processed_platforms += 1
+            self.set_progress(processed_platforms / total_platforms)
+            self.set_status(f"Processing platforms... ({processed_platforms}/{total_platforms})")
+    
+    def watch_for_changes(self, metadata, platform_folders):
+        """Scrape the ROMs added to scan_path from now on, until the scan is cancelled
+        
+        Changes are seen right away with inotify, or by listing the folders every
+        watch_interval seconds where it can't be used. Once no ROM has changed
+        for watch_debounce seconds (a copy in progress keeps changing), just the
+        platforms that changed are scanned incrementally. Metadata, match
+        indexes, caches and downloads stay open the whole time.
+        """
+        root = None if platform_folders == [self.scan_path] else self.scan_path
+        platform_folders = list(platform_folders)
+        watched = {}  # folder -> (its platform folder, depth)
+        listings = dict(self.folder_listings)
+        ignore = [pattern.lower() for pattern in self.discovery_ignore]
+        watcher = None
+        
+        def watch_tree(platform_folder, folder, depth):
+            watcher.add(folder)
+            watched[folder] = (platform_folder, depth)
+            if depth < self.discovery_depth:
+                for subfolder, _ in list_rom_folder(folder, "", ignore, subfolders=True)[1]:
+                    watch_tree(platform_folder, subfolder, depth + 1)
+        
+        def changed_platform(folder, name, mask):
+            """Return the platform folder an inotify event changed, None if it changed nothing we scan"""
+            if folder is None:
+                return None
+            added = mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO)
+            is_dir = mask & InotifyWatcher.IN_ISDIR
+            if folder == root:
+                if not (is_dir and added and name.lower() in PLATFORM_MAPPING) or folder / name in platform_folders:
+                    return None
+                platform_folders.append(folder / name)
+                platform_folder, path, depth = folder / name, folder / name, 0
+            elif any(fnmatch.fnmatchcase(name.lower(), pattern) for pattern in ignore):
+                return None
+            elif is_dir:
+                platform_folder, depth = watched[folder]
+                if depth >= self.discovery_depth or name.lower() == "images" or name.startswith("."):
+                    return None
+                if not added:
+                    return platform_folder
+                path, depth = folder / name, depth + 1
+            elif os.path.splitext(name)[1].lower() in SCAN_EXTENSIONS:
+                return watched[folder][0]
+            else:
+                return None
+            
+            # A new folder to watch. It may be gone already, it is rescanned either way.
+            try:
+                watch_tree(platform_folder, path, depth)
+            except OSError as e:
+                self.logger.warning(f"Can't watch {path}: {str(e)}")
+            return platform_folder
+        
+        if not self.watch_polling:
+            try:
+                watcher = InotifyWatcher()
+                if root is not None:
+                    watcher.add(root)
+                for platform_folder in platform_folders:
+                    watch_tree(platform_folder, platform_folder, 0)
+            except OSError as e:
+                if watcher is not None:
+                    watcher.close()
+                    watcher = None
+                msg = f"Can't watch folders with inotify ({str(e)}), looking for changes every {self.watch_interval}s instead"
+                self.log(msg)
+                self.logger.warning(msg)
+        
+        msg = f"Watching {self.scan_path} for new ROMs..."
+        self.log(msg)
+        self.logger.info(msg)
+        self.set_status("Watching for new ROMs")
+        
+        dirty = set()
+        last_change = time.monotonic()
+        next_poll = last_change + self.watch_interval
+        try:
+            while self.scanning:
+                changed = set()
+                polled = False
+                if watcher is not None:
+                    for folder, name, mask in watcher.read(timeout=0.5):
+                        if folder is None:
+                            # Events were lost, anything may have changed
+                            changed.update(platform_folders)
+                        else:
+                            changed.add(changed_platform(folder, name, mask))
+                    changed.discard(None)
+                elif time.monotonic() >= next_poll:
+                    changed = self.poll_for_changes(root, platform_folders, listings)
+                    polled = True
+                    # While files are changing, look again as soon as they may have settled
+                    next_poll = time.monotonic() + (self.watch_debounce if changed else self.watch_interval)
+                else:
+                    time.sleep(0.5)
+                
+                now = time.monotonic()
+                if changed:
+                    dirty |= changed
+                    last_change = now
+                elif dirty and (now - last_change >= self.watch_debounce if watcher is not None else polled):
+                    batch, dirty = sorted(dirty), set()
+                    self.scan_changes(metadata, batch)
+        finally:
+            if watcher is not None:
+                watcher.close()
+    
+    def poll_for_changes(self, root, platform_folders, listings):
+        """List the watched folders again; return the platform folders whose ROMs differ from listings
+        
+        listings is updated to what was found. New platform folders in root are picked up too.
+        """
+        if root is not None:
+            for platform_folder in list_platform_folders(root):
+                if platform_folder not in platform_folders:
+                    platform_folders.append(platform_folder)
+        
+        changed = set()
+        for platform_folder, listing in self.discover(platform_folders):
+            if listing != listings.get(platform_folder, {}):
+                changed.add(platform_folder)
+                listings[platform_folder] = listing
+        return changed
+    
+    def scan_changes(self, metadata, platform_folders):
+        """Scan the ROMs added, changed or removed in some platform folders while watching
+        
+        Matching runs on the scan thread, against the platform indexes already
+        built, which for a handful of new ROMs beats starting worker processes.
+        """
+        self.log(f"ROMs changed in {', '.join(platform_folder.name.lower() for platform_folder in platform_folders)}, scanning...")
+        self.rom_titles = {}
+        self.exclusion_stores = {}
+        platforms = ((platform_folder, games, None) for platform_folder, games
+                     in self.discover_platforms(platform_folders, metadata, incremental=True))
+        self.process_platforms(platforms, metadata, len(platform_folders))
+        
+        if self.metrics_textfile_path is not None:
+            try:
+                self.metrics.write_textfile(self.metrics_textfile_path)
+            except OSError as e:
+                self.logger.error(f"Error saving scan metrics: {str(e)}")
+        self.set_status("Watching for new ROMs")
+    
+    def write_metrics(self):
+        """Save the scan's metrics as a JSON summary and a Prometheus textfile, and log the highlights"""
+        summary = self.metrics.summary()
+        matches, downloads = summary["matches"], summary["downloads"]
+        msg = (f"Scan took {summary['duration_seconds']:.1f}s: {matches['exact']} exact, {matches['fuzzy']} fuzzy, "
+               f"{matches['miss']} unmatched; {downloads['files']} images downloaded "
+               f"({downloads['bytes'] / (1024 * 1024):.1f} MB)")
+        self.log(msg)
+        self.logger.info(msg)
+        
+        try:
+            if self.metrics_summary_path is not None:
+                summary_path = Path(self.metrics_summary_path)
+            else:
+                LOG_DIR.mkdir(exist_ok=True)
+                summary_path = LOG_DIR / f"scan_{datetime.fromtimestamp(self.metrics.started).strftime('%Y%m%d_%H%M%S')}.json"
+            with open(summary_path, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
+            self.logger.info(f"Saved scan summary: {summary_path}")
+            
+            if self.metrics_textfile_path is not None:
+                self.metrics.write_textfile(self.metrics_textfile_path)
+        except OSError as e:
+            self.logger.error(f"Error saving scan metrics: {str(e)}")
+        return summary
+    
+    def discover(self, platform_folders):
+        """List the ROMs of each platform folder, down to discovery_depth levels of subfolders
+        
+        Folders are listed with os.scandir on a small thread pool, so the many
+        round trips to a network share overlap. Yields (platform_folder, listing)
+        as soon as a platform's whole tree is listed, listing mapping ROM path
+        to (size, mtime_ns, inode) as list_rom_folder does.
+        """
+        ignore = [pattern.lower() for pattern in self.discovery_ignore]
+        listings = {platform_folder: {} for platform_folder in platform_folders}
+        outstanding = Counter()
+        futures = {}
+        executor = ThreadPoolExecutor(max_workers=max(1, self.discovery_workers))
+        
+        def submit(platform_folder, folder, prefix, depth):
+            future = executor.submit(list_rom_folder, folder, prefix, ignore, depth < self.discovery_depth)
+            futures[future] = (platform_folder, folder, depth)
+            outstanding[platform_folder] += 1
+        
+        try:
+            for platform_folder in platform_folders:
+                submit(platform_folder, platform_folder, "", 0)
+            
+            while futures:
+                with self.metrics.stage("discovery"):
+                    done, _ = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+                if not self.scanning:
+                    return
+                
+                for future in done:
+                    platform_folder, folder, depth = futures.pop(future)
+                    outstanding[platform_folder] -= 1
+                    try:
+                        listing, subfolders = future.result()
+                    except OSError as e:
+                        msg = f"Could not list {folder}: {str(e)}"
+                        self.log(msg)
+                        self.logger.warning(msg)
+                        listing, subfolders = {}, []
+                    
+                    listings[platform_folder].update(listing)
+                    for subfolder, prefix in subfolders:
+                        submit(platform_folder, subfolder, prefix, depth + 1)
+                    if not outstanding[platform_folder]:
+                        yield platform_folder, listings.pop(platform_folder)
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+    
+    def discover_platforms(self, platform_folders, metadata, incremental=None):
+        """Yield (platform_folder, games) for each platform folder with ROMs, as soon as it is listed
+        
+        Incremental scans (self.incremental unless incremental is given) only
+        yield the ROMs that were added or changed and skip platforms where
+        nothing did. ROMs are identified by hash, if there are DAT files,
+        before their platform is yielded.
+        """
+        if incremental is None:
+            incremental = self.incremental
+        found = 0
+        for platform_folder, listing in self.discover(platform_folders):
+            platform_name = platform_folder.name.lower()
+            if not listing:
+                self.logger.warning(f"No game files found in {platform_folder}")
+                # Its last ROMs were deleted since the last scan: still prune them and update the snapshot
+                if not self.load_snapshot(platform_folder):
+                    continue
+            
+            self.folder_listings[platform_folder] = listing
+            self.metrics.inc("roms_found", len(listing), platform=platform_name)
+            found += len(listing)
+            self.log(f"Found {len(listing)} game files in {platform_name}")
+            self.logger.info(f"Found {len(listing)} game files in {platform_name}")
+            
+            games = [platform_folder / name for name in listing]
+            # Refresh mode has to look at every entry, so it always scans everything
+            if incremental and not self.refresh_existing:
+                games = self.changes_since_last_scan(platform_folder, games, metadata)
+                if games is None:
+                    continue
+            
+            with self.metrics.stage("identify"):
+                rom_titles = self.identify_roms(platform_folder, games, metadata)
+            self.rom_titles.update(rom_titles)
+            self.metrics.inc("roms_identified", len(rom_titles))
+            if not self.scanning:
+                return
+            
+            yield platform_folder, games
+        
+        if found:
+            msg = f"Found {found} game files across {len(self.folder_listings)} platforms"
+            self.log(msg)
+            self.logger.info(msg)
+    
+    def load_dat_index(self):
+        """Return the DatIndex of dat_path, or None if there are no DAT files to identify ROMs with"""
+        if not self.dat_path.is_dir():
+            return None
+        
+        try:
+            dat_index = DatIndex(self.dat_path)
+        except (ET.ParseError, OSError) as e:
+            msg = f"Could not load DAT files from {self.dat_path}: {str(e)}"
+            self.log(msg)
+            self.logger.warning(msg)
+            return None
+        if not len(dat_index):
+            return None
+        self.logger.info(f"Loaded {len(dat_index)} ROM hashes from {dat_index.dat_count} DAT files")
+        return dat_index
+    
+    def identify_roms(self, platform_folder, games, metadata):
+        """Hash a platform's ROMs that still need matching and look them up in the DAT files
+        
+        Returns a dict of ROM path -> canonical title for every ROM found. Empty
+        if no DAT files were loaded, hashing is only done when DATs are present.
+        """
+        dat_index = self.dat_index
+        if dat_index is None:
+            return {}
+        
+        rom_files = [platform_folder / name for name in self.games_to_match(platform_folder, games, metadata)
+                     if os.path.splitext(name)[1].lower() not in UNHASHED_EXTENSIONS]
+        if not rom_files:
+            return {}
+        
+        self.log(f"Hashing {len(rom_files)} ROMs...")
+        rom_titles = {}
+        hashed = 0
+        # hashlib and zlib release the GIL on large buffers, so threads hash in parallel
+        executor = ThreadPoolExecutor(max_workers=max(1, self.hash_workers))
+        try:
+            futures = {executor.submit(hash_rom, rom_file): rom_file for rom_file in rom_files}
+            outstanding = set(futures)
+            while outstanding:
+                done, outstanding = wait(outstanding, timeout=0.5, return_when=FIRST_COMPLETED)
+                if not self.scanning:
+                    break
+                
+                for future in done:
+                    rom_file = futures[future]
+                    try:
+                        title = dat_index.title_for(future.result())
+                    except (OSError, zipfile.BadZipFile, ValueError) as e:
+                        self.logger.warning(f"Could not hash {rom_file}: {str(e)}")
+                        continue
+                    if title is not None:
+                        rom_titles[rom_file] = title
+                        self.logger.info(f"Identified {rom_file.name} by hash as {title}")
+                
+                hashed += len(done)
+                self.set_status(f"Hashing ROMs... ({hashed}/{len(rom_files)})")
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        
+        msg = f"Identified {len(rom_titles)} of {len(rom_files)} ROMs in {platform_folder.name.lower()} by hash"
+        self.log(msg)
+        self.logger.info(msg)
+        return rom_titles
+    
+    def rom_lookup_name(self, game_file):
+        """Return the cleaned name a ROM is matched by: its DAT title if it was identified, else its file name"""
+        title = self.rom_titles.get(game_file)
+        return clean_game_name(title if title is not None else game_file.stem)
+    
+    def match_in_parallel(self, platforms, metadata):
+        """Match the new games of each platform on a process pool
+        
+        platforms yields (platform_folder, games), see discover_platforms; each
+        platform's chunks go to the pool as soon as it arrives. Yields
+        (platform_folder, games, matches) once all of a platform's chunks are
+        done, matches mapping ROM path to the (database_id, score, exact) found
+        by a worker. Closing the generator cancels outstanding work.
+        """
+        executor = None
+        cancelled = PROCESS_CONTEXT.Event()
+        futures = {}
+        remaining = {}
+        matches = {}
+        games_by_platform = {}
+        chunk_count = 0
+        done_chunks = 0
+        
+        def finished(done):
+            nonlocal done_chunks
+            for future in done:
+                platform_folder, metadata_platform = futures.pop(future)
+                for rom_name, lookup_name, database_id, score, exact in future.result():
+                    matches[platform_folder][rom_name] = (database_id, score, exact)
+                    if self.match_cache is not None:
+                        self.match_cache.put(metadata_platform, lookup_name, database_id, score, exact)
+                
+                done_chunks += 1
+                self.set_status(f"Matching games... ({done_chunks}/{chunk_count} chunks)")
+                remaining[platform_folder] -= 1
+                if not remaining[platform_folder]:
+                    yield platform_folder, games_by_platform.pop(platform_folder), matches.pop(platform_folder)
+        
+        try:
+            for platform_folder, games in platforms:
+                metadata_platform = PLATFORM_MAPPING.get(platform_folder.name.lower(), "")
+                pending = self.games_to_match(platform_folder, games, metadata) if metadata_platform else []
+                platform_matches = {}
+                
+                # Games matched by an earlier scan don't need a worker
+                if self.match_cache is not None:
+                    uncached = []
+                    for rom_name in pending:
+                        match = self.match_cache.get(metadata_platform, self.rom_lookup_name(platform_folder / rom_name).lower())
+                        if match is not None:
+                            platform_matches[rom_name] = match
+                        else:
+                            uncached.append(rom_name)
+                        self.metrics.inc("cache_requests", cache="match", result="hit" if match is not None else "miss")
+                    pending = uncached
+                
+                # Platforms with nothing new to match don't need to wait for the pool
+                if not pending:
+                    yield platform_folder, games, platform_matches
+                    continue
+                
+                if executor is None:
+                    self.logger.info(f"Matching on {self.match_workers} processes")
+                    executor = ProcessPoolExecutor(max_workers=self.match_workers, initializer=_init_match_worker,
+                                                   initargs=(str(self.metadata_index_path), cancelled),
+                                                   mp_context=PROCESS_CONTEXT)
+                self.log(f"Matching {len(pending)} games in {platform_folder.name.lower()}...")
+                
+                lookups = [(rom_name, self.rom_lookup_name(platform_folder / rom_name).lower()) for rom_name in pending]
+                matches[platform_folder] = platform_matches
+                games_by_platform[platform_folder] = games
+                remaining[platform_folder] = 0
+                for start in range(0, len(lookups), MATCH_CHUNK_SIZE):
+                    future = executor.submit(_match_chunk, metadata_platform, lookups[start:start + MATCH_CHUNK_SIZE])
+                    futures[future] = (platform_folder, metadata_platform)
+                    remaining[platform_folder] += 1
+                    chunk_count += 1
+                
+                # Hand over platforms that are done while the others are still being listed
+                yield from finished([future for future in futures if future.done()])
+            
+            while futures:
+                # Only the time spent waiting on the pool, not the platforms processed in between
+                with self.metrics.stage("match"):
+                    done, _ = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+                if not self.scanning:
+                    return
+                yield from finished(done)
+        finally:
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=True)
+    
+    def get_platform_index(self, metadata, metadata_platform):
+        """Return the match index of a metadata platform, building it on first use
+        
+        Platform folders that map to the same metadata platform share one index.
+        """
+        platform_index = self.platform_indexes.get(metadata_platform)
+        if platform_index is None:
+            platform_index = PlatformIndex(metadata_platform, metadata.games_for_platform(metadata_platform),
+                                           metadata.alternate_names_for_platform(metadata_platform))
+            self.platform_indexes[metadata_platform] = platform_index
+            self.logger.info(f"Indexed {len(platform_index)} metadata names for {metadata_platform}")
+        return platform_index
+    
+    def games_to_match(self, platform_folder, games, metadata):
+        """Return the ROM paths (see rom_path) of the games that need matching
+        
+        That is the first file of every title with a gamelist entry to add,
+        one that is neither excluded nor in gamelist.xml yet.
+        """
+        excluded_files = self.load_exclusions(platform_folder, metadata)
+        existing_paths = {game_elem.findtext("path") for game_elem in self.load_gamelist(platform_folder).iter("game")}
+        names = []
+        for title_stem, group_files in group_games(games):
+            for entry_file in self.group_entries(platform_folder, title_stem, group_files):
+                entry_path = rom_path(platform_folder, entry_file)
+                if entry_path not in excluded_files and f"./{entry_path}" not in existing_paths:
+                    names.append(rom_path(platform_folder, group_files[0]))
+                    break
+        return names
+    
+    def load_gamelist(self, platform_folder):
+        """Return the root of a platform folder's gamelist.xml, parsed once until its platform is processed
+        
+        A new, empty gameList if there is no gamelist.xml or it can't be parsed.
+        """
+        root = self.gamelists.get(platform_folder)
+        if root is not None:
+            return root
+        
+        gamelist_path = platform_folder / "gamelist.xml"
+        if gamelist_path.exists():
+            try:
+                with self.metrics.stage("gamelist_read", platform=platform_folder.name.lower()):
+                    root = ET.parse(gamelist_path).getroot()
+            except ET.ParseError as e:
+                msg = f"Error parsing {gamelist_path}: {str(e)}. Creating a new one."
+                self.log(msg)
+                self.logger.warning(msg)
+                # If the XML is invalid, create a new root
+                root = ET.Element("gameList")
+        else:
+            # Create new gamelist
+            root = ET.Element("gameList")
+            self.logger.info(f"Creating new gamelist.xml at {gamelist_path}")
+        self.gamelists[platform_folder] = root
+        return root
+    
+    def group_entries(self, platform_folder, title_stem, group_files):
+        """Return the files a title gets gamelist entries for: its playlist, or each of its files"""
+        if self.generate_playlists and disc_count(group_files) > 1:
+            return [group_files[0].parent / f"{title_stem}.m3u"]
+        return group_files
+    
+    def write_playlist(self, playlist_path, group_files):
+        """Write an .m3u listing one file per disc, unless the playlist already exists"""
+        if playlist_path.exists():
+            return
+        discs = {}
+        for game_file in group_files:
+            discs.setdefault(split_disc_tag(game_file.stem)[1], game_file.name)
+        try:
+            with open(playlist_path, 'w', encoding='utf-8', newline='\n') as f:
+                for file_name in discs.values():
+                    f.write(f"{file_name}\n")
+            self.logger.info(f"Created playlist {playlist_path}")
+        except OSError as e:
+            self.logger.error(f"Error creating playlist {playlist_path}: {str(e)}")
+    
+    def write_gamelist(self, root, gamelist_path):
+        """Write a gameList element to gamelist.xml, tab indented
+        
+        Entries are formatted one at a time (see gamelist_chunks), so the
+        document never exists as a whole string. The file is written next to
+        gamelist.xml, synced to disk and renamed over it, so a crash leaves
+        either the old or the new gamelist, never half of one.
+        """
+        tmp_path = gamelist_path.with_name(gamelist_path.name + ".tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for chunk in gamelist_chunks(root):
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, gamelist_path)
+        except BaseException:
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            raise
+    
+    def changes_since_last_scan(self, platform_folder, games, metadata):
+        """Compare a platform folder with its snapshot from the last scan
+        
+        Returns the ROMs added or changed, plus the excluded ROMs that are
+        retried because the games they can match changed (see load_exclusions),
+        or None if nothing changed at all. Platforms where ROMs were only
+        removed get an empty list, so they can be pruned. A platform without a
+        snapshot counts as entirely new.
+        """
+        listing = self.folder_listings[platform_folder]
+        snapshot = self.load_snapshot(platform_folder)
+        if snapshot is None:
+            return games
+        
+        # A changed disc brings the rest of its game along, so it is grouped the same way
+        exclusions = self.load_exclusions(platform_folder, metadata)
+        retry = exclusions.retry
+        changed = []
+        retried = 0
+        for title_stem, group_files in group_games(games):
+            if any(snapshot.get(path) != listing[path]
+                   for path in (rom_path(platform_folder, game_file) for game_file in group_files)):
+                changed.extend(group_files)
+            elif retry and any(rom_path(platform_folder, entry_file) in retry
+                               for entry_file in self.group_entries(platform_folder, title_stem, group_files)):
+                changed.extend(group_files)
+                retried += len(group_files)
+        removed = [name for name in snapshot if name not in listing]
+        if not changed and not removed:
+            # Nothing to scan, but save the exclusions just checked against this metadata
+            try:
+                exclusions.flush()
+            except OSError as e:
+                self.logger.error(f"Error writing exclusion file {exclusions.path}: {str(e)}")
+            return None
+        
+        msg = (f"Incremental scan of {platform_folder.name.lower()}: {len(changed) - retried} game files added or changed, "
+               f"{len(removed)} removed, {retried} excluded files retried")
+        self.log(msg)
+        self.logger.info(msg)
+        return changed
+    
+    def load_snapshot(self, platform_folder):
+        """Return the {ROM path: (size, mtime_ns, inode)} saved by the last scan, or None"""
+        snapshot_file = platform_folder / SNAPSHOT_FILE
+        try:
+            with open(snapshot_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") != SNAPSHOT_VERSION:
+                return None
+            return {name: tuple(stat) for name, stat in data["files"].items()}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            self.logger.warning(f"Ignoring unreadable snapshot {snapshot_file}: {str(e)}")
+            return None
+    
+    def save_snapshot(self, platform_folder, listing):
+        snapshot_file = platform_folder / SNAPSHOT_FILE
+        temp_file = snapshot_file.with_name(snapshot_file.name + ".tmp")
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump({"version": SNAPSHOT_VERSION, "files": listing}, f)
+            os.replace(temp_file, snapshot_file)
+        except OSError as e:
+            self.logger.error(f"Error saving snapshot {snapshot_file}: {str(e)}")
+    
+    def process_platform(self, platform_folder, games, metadata, matches=None):
+        """Process all games in a platform folder and update gamelist.xml once
+        
+        matches optionally holds matches already found by match_in_parallel.
+        """
+        platform_name = platform_folder.name.lower()
+        metadata_platform = PLATFORM_MAPPING.get(platform_name, "")
+        
+        if not metadata_platform:
+            msg = f"Skipping platform {platform_name}: No platform mapping found"
+            self.log(msg)
+            self.logger.warning(msg)
+            return
+        
+        # Load or create exclusion list
+        exclusions = self.load_exclusions(platform_folder, metadata)
+        
+        # Load or create gamelist.xml
+        gamelist_path = platform_folder / "gamelist.xml"
+        backup_created = False
+        
+        if gamelist_path.exists():
+            # Create backup only once per platform
+            backup_path = platform_folder / "gamelist.xml.bak"
+            if not backup_path.exists():
+                shutil.copy2(gamelist_path, backup_path)
+                backup_created = True
+                self.logger.info(f"Created backup of gamelist.xml: {backup_path}")
+        
+        # Usually parsed already, when the games to match were picked. Watch
+        # mode comes back to platforms, so it's read again from disk next time.
+        root = self.load_gamelist(platform_folder)
+        del self.gamelists[platform_folder]
+        
+        # Index existing entries by path so each ROM is an O(1) lookup
+        existing_games = {}
+        for game_elem in root.findall("game"):
+            path = game_elem.findtext("path")
+            if path and path not in existing_games:
+                existing_games[path] = game_elem
+        
+        pruned_games = 0
+        if self.prune_removed and platform_folder in self.folder_listings:
+            pruned_games = self.prune_games(platform_folder, root, self.folder_listings[platform_folder])
+        
+        # Process each game in the platform folder
+        processed_games = 0
+        refreshed_games = 0
+        unrefreshed_games = 0
+        total_games = len(games)
+        
+        # Discs of the same game are matched together, see group_games
+        for title_stem, group_files in group_games(games):
+            if not self.scanning:
+                break
+            
+            new_files = []
+            for game_file in self.group_entries(platform_folder, title_stem, group_files):
+                game_path = rom_path(platform_folder, game_file)
+                # Check if file is in exclusion list
+                if game_path in exclusions:
+                    msg = f"Skipping {game_path}: File is in exclusion list"
+                    self.log(msg)
+                    self.logger.info(msg)
+                    continue
+                    
+                existing_game = existing_games.get(f"./{game_path}")
+                if existing_game is not None:
+                    refreshed = False
+                    if self.refresh_existing:
+                        refreshed = self.refresh_game(existing_game, game_file, metadata, metadata_platform)
+                        if refreshed is None:
+                            unrefreshed_games += 1
+                    if refreshed:
+                        refreshed_games += 1
+                    else:
+                        msg = f"Skipping {game_path}: Already exists in gamelist.xml"
+                        self.log(msg)
+                        self.logger.info(msg)
+                else:
+                    new_files.append(game_file)
+            
+            if new_files:
+                if new_files[0].suffix == ".m3u":
+                    self.write_playlist(new_files[0], group_files)
+                match_file = group_files[0]
+                if self.process_game(platform_folder, new_files, metadata, metadata_platform, root, exclusions,
+                                     matches.get(rom_path(platform_folder, match_file)) if matches is not None else None,
+                                     match_file=match_file,
+                                     image_stem=rom_path(platform_folder, match_file.parent / title_stem)):
+                    processed_games += len(new_files)
+                
+            self.log(f"Processed {processed_games}/{total_games} games in {platform_name}")
+        
+        if unrefreshed_games:
+            msg = (f"Could not refresh {unrefreshed_games} entries in {platform_name}: "
+                   "no LaunchBox game matches their id, or their name exactly")
+            self.log(msg)
+            self.logger.warning(msg)
+        
+        if self.match_cache is not None:
+            self.match_cache.commit()
+        try:
+            exclusions.flush()
+        except OSError as e:
+            self.logger.error(f"Error writing exclusion file {exclusions.path}: {str(e)}")
+        
+        # Only write to file if we found new games to add or changed old ones
+        if processed_games > 0 or refreshed_games > 0 or pruned_games > 0:
+            with self.metrics.stage("gamelist_write", platform=platform_name):
+                self.write_gamelist(root, gamelist_path)
+            
+            msg = f"Updated gamelist.xml for {platform_name} with {processed_games} new games"
+            if refreshed_games:
+                msg += f" and {refreshed_games} refreshed"
+            if pruned_games:
+                msg += f", {pruned_games} removed"
+            self.logger.info(msg)
+            self.log(msg)
+    
+    def prune_games(self, platform_folder, root, listing):
+        """Remove the gamelist entries of deleted ROMs and the images only they used
+        
+        An entry is pruned when its path names a ROM within discovery_depth of
+        the platform folder that is not in listing anymore; entries for other
+        files are left alone. Returns the number of entries removed. Only files
+        inside the platform's images folder are ever deleted.
+        """
+        image_tags = [tag for _, tag in ARTWORK_TYPES]
+        pruned = []
+        for game_elem in root.findall("game"):
+            path = game_elem.findtext("path") or ""
+            name = path[2:]
+            if path.startswith("./") and name not in listing and self.is_discoverable(name):
+                root.remove(game_elem)
+                pruned.append(game_elem)
+        
+        # Images can be shared, e.g. by a .cue and a .chd of the same game
+        still_used = {game_elem.findtext(tag) for game_elem in root.findall("game") for tag in image_tags}
+        images_dir = (platform_folder / "images").resolve()
+        for game_elem in pruned:
+            for tag in image_tags:
+                image_text = game_elem.findtext(tag)
+                if not image_text or image_text in still_used:
+                    continue
+                image_path = (platform_folder / image_text).resolve()
+                if images_dir not in image_path.parents:
+                    continue
+                if self.download_queue is not None:
+                    self.download_queue.remove(platform_folder / "images" / image_path.relative_to(images_dir))
+                try:
+                    image_path.unlink()
+                    self.logger.info(f"Deleted image of removed game: {image_path}")
+                    # Drop the image subfolder of a ROM subfolder once it is empty
+                    if image_path.parent != images_dir:
+                        try:
+                            image_path.parent.rmdir()
+                        except OSError:
+                            pass
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.logger.error(f"Error deleting image {image_path}: {str(e)}")
+            
+            msg = f"Removed {game_elem.findtext('path')[2:]} from gamelist.xml: file no longer exists"
+            self.log(msg)
+            self.logger.info(msg)
+        return len(pruned)
+    
+    def is_discoverable(self, path):
+        """Return True if discovery would list a ROM at path (see rom_path), given its depth and ignore rules"""
+        if os.path.splitext(path)[1].lower() not in SCAN_EXTENSIONS:
+            return False
+        parts = path.split("/")
+        if len(parts) > self.discovery_depth + 1:
+            return False
+        if any(not folder or folder.startswith(".") or folder.lower() == "images" for folder in parts[:-1]):
+            return False
+        ignore = [pattern.lower() for pattern in self.discovery_ignore]
+        return not any(fnmatch.fnmatchcase(part.lower(), pattern) for part in parts for pattern in ignore)
+    
+    def load_exclusions(self, platform_folder, metadata):
+        """Return a platform folder's ExclusionStore, loaded once per scan
+        
+        Entries excluded with another metadata version are only tried again if
+        their platform's match candidates changed since. The others are marked
+        current, so the next scan doesn't have to check them again.
+        """
+        exclusions = self.exclusion_stores.get(platform_folder)
+        if exclusions is not None:
+            return exclusions
+        
+        exclusions = ExclusionStore(platform_folder / EXCLUSION_FILE)
+        try:
+            exclusions.load()
+            if len(exclusions):
+                self.logger.info(f"Loaded {len(exclusions)} files from exclusion list: {exclusions.path}")
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Error reading exclusion file {exclusions.path}: {str(e)}")
+            # Don't overwrite a list that couldn't be read
+            exclusions.writable = False
+        
+        metadata_platform = PLATFORM_MAPPING.get(platform_folder.name.lower(), "")
+        stale = [name for name, (version, _, _) in exclusions.entries.items() if version != self.metadata_version]
+        if stale:
+            fingerprint = metadata.platform_fingerprint(metadata_platform)
+            for name in stale:
+                _, entry_fingerprint, score = exclusions.entries[name]
+                if entry_fingerprint is not None and entry_fingerprint == fingerprint:
+                    exclusions.add(name, self.metadata_version, fingerprint, score)
+                else:
+                    exclusions.retry.add(name)
+            if exclusions.retry:
+                msg = f"Retrying {len(exclusions.retry)} excluded files in {platform_folder.name.lower()}: the games they can match changed"
+                self.log(msg)
+                self.logger.info(msg)
+        
+        self.exclusion_stores[platform_folder] = exclusions
+        return exclusions
+    
+    def process_game(self, platform_folder, game_files, metadata, metadata_platform, root, exclusions,
+                     match=None, match_file=None, image_stem=None):
+        """Match one game and add an entry for each of game_files to the XML root
+        
+        game_files are the discs (or the playlist) of a game that are not in
+        gamelist.xml yet. The game is matched by match_file, the first of them by
+        default, and its artwork is downloaded once, named after image_stem (a
+        path within the images folder, so that games in subfolders don't collide).
+        match is the (database_id, score, exact) of a match already made by a worker process.
+        Otherwise the match cache is tried before matching. ROMs identified by hash
+        are matched by their DAT title, which is normally an exact hit.
+        """
+        game_file = match_file or game_files[0]
+        # Find matching game in metadata, by DAT title if the ROM's hash was known
+        game_name_no_ext = self.rom_lookup_name(game_file)
+        lookup_name = game_name_no_ext.lower()
+        platform_name = platform_folder.name.lower()
+        if match is None and self.match_cache is not None:
+            match = self.match_cache.get(metadata_platform, lookup_name)
+            self.metrics.inc("cache_requests", cache="match", result="hit" if match is not None else "miss")
+        
+        if match is not None:
+            database_id, best_score, exact_match = match
+            best_match = metadata.game_by_id(database_id) if database_id else None
+        else:
+            with self.metrics.stage("match", platform=platform_name):
+                platform_index = self.get_platform_index(metadata, metadata_platform)
+                best_match, best_score, exact_match = platform_index.match(lookup_name)
+            if self.match_cache is not None:
+                self.match_cache.put(metadata_platform, lookup_name,
+                                     best_match.database_id if best_match is not None else None,
+                                     best_score, exact_match)
+        
+        match_kind = "miss" if best_match is None else "exact" if exact_match else "fuzzy"
+        self.metrics.inc("matches", platform=platform_name, kind=match_kind)
+        
+        if best_match is None:
+            msg = f"No metadata found for {game_file.name} (cleaned: {game_name_no_ext}) on platform {metadata_platform}"
+            self.log(msg)
+            self.logger.info(msg)
+            
+            # Add to exclusion list, written when the platform is done
+            fingerprint = metadata.platform_fingerprint(metadata_platform)
+            for excluded_file in game_files:
+                excluded_path = rom_path(platform_folder, excluded_file)
+                exclusions.add(excluded_path, self.metadata_version, fingerprint, best_score)
+                self.log(f"Added {excluded_path} to exclusion list")
+                self.logger.info(f"Added {excluded_path} to exclusion list: {exclusions.path}")
+            
+            return False
+        
+        match_type = "exact" if exact_match else f"fuzzy (score: {best_score:.2f})"
+        msg = f"Processing {', '.join(rom_path(platform_folder, entry_file) for entry_file in game_files)} -> {best_match.name} ({match_type})"
+        self.log(msg)
+        self.logger.info(msg)
+        
+        # Add game to XML, a retried ROM leaves the exclusion list
+        for entry_file in game_files:
+            entry_path = rom_path(platform_folder, entry_file)
+            self.add_game_to_xml(root, entry_file, best_match, image_stem, entry_path)
+            exclusions.remove(entry_path)
+        
+        # Download images
+        with self.metrics.stage("download_queue", platform=platform_name):
+            self.download_images(platform_folder, game_files[0], best_match, metadata, image_stem)
+        
+        return True
+    
+    def add_game_to_xml(self, root, game_file, game_record, image_stem=None, path=None):
+        # Create game element, tagged with its DatabaseID so refresh mode can find it again
+        game = ET.SubElement(root, "game")
+        if game_record.database_id:
+            game.set("id", game_record.database_id)
+            game.set("source", GAMELIST_SOURCE)
+        
+        for tag, text in self.game_fields(game_file, game_record, image_stem, path):
+            ET.SubElement(game, tag).text = text
+    
+    def refresh_game(self, game, game_file, metadata, metadata_platform):
+        """Rewrite stale metadata fields of an existing gamelist entry in place
+        
+        Entries we added carry the DatabaseID of the game they were matched to.
+        Others, such as those written by older versions, are only refreshed if
+        their ROM or <name> matches a game's name exactly; they get its
+        DatabaseID for next time. Returns True if anything changed, False if the
+        entry is up to date and None if it can't be tied to a game.
+        """
+        changed = []
+        if game.get("source") == GAMELIST_SOURCE and game.get("id"):
+            game_record = metadata.game_by_id(game.get("id"))
+        else:
+            names = self.get_platform_index(metadata, metadata_platform).names
+            game_record = names.get(self.rom_lookup_name(game_file).lower())
+            if game_record is None:
+                game_record = names.get(clean_game_name(game.findtext("name") or "").lower())
+            if game_record is not None and game_record.database_id:
+                game.set("id", game_record.database_id)
+                game.set("source", GAMELIST_SOURCE)
+                changed.append("id")
+        if game_record is None:
+            return None
+        
+        for tag, text in self.game_fields(game_file, game_record):
+            if tag not in REFRESH_FIELDS:
+                continue
+            elem = game.find(tag)
+            if elem is None:
+                elem = ET.SubElement(game, tag)
+            if (elem.text or "") != text:
+                elem.text = text
+                changed.append(tag)
+        
+        if changed:
+            msg = f"Refreshed {game_file.name}: {', '.join(changed)}"
+            self.log(msg)
+            self.logger.info(msg)
+        return bool(changed)
+    
+    def game_fields(self, game_file, game_record, image_stem=None, path=None):
+        """Return the gamelist.xml (tag, text) pairs of a game, in file order
+        
+        path is the ROM's path within its platform folder (see rom_path), its
+        file name by default. Image paths are named after image_stem, the file's
+        own stem by default; a stem with a subfolder mirrors it inside images/.
+        """
+        fields = []
+        
+        # Add path
+        fields.append(("path", f"./{path or game_file.name}"))
+        
+        # Add name
+        fields.append(("name", game_record.name or ""))
+        
+        # Add description
+        desc_text = game_record.overview or ""
+        # Clean up description text
+        desc_text = re.sub(r'\s+', ' ', desc_text).strip()
+        fields.append(("desc", desc_text))
+        
+        # Add image paths
+        image_base = f"./images/{image_stem or game_file.stem}"
+        fields.append(("image", f"{image_base}-image.png"))
+        fields.append(("marquee", f"{image_base}-marquee.png"))
+        fields.append(("thumbnail", f"{image_base}-thumbnail.png"))
+        
+        # Add rating (convert from 0-5 scale to 0-1 scale)
+        rating_text = "0.00"
+        community_rating = game_record.community_rating
+        if community_rating:
+            try:
+                # Convert from 0-5 scale to 0-1 scale
+                rating = float(community_rating) / 5.0
+                rating_text = f"{rating:.2f}"[:4]  # Format to 2 decimal places
+            except ValueError:
+                self.logger.warning(f"Invalid rating value: {community_rating}")
+        fields.append(("rating", rating_text))
+        
+        # Add release date
+        release_text = ""
+        release_date = game_record.release_date
+        if release_date:
+            # Extract date part only (YYYY-MM-DD)
+            date_match = re.search(r'(\d{4}-\d{2}-\d{2})', release_date)
+            if date_match:
+                date_str = date_match.group(1).replace("-", "")
+                release_text = date_str + "T000000"
+            else:
+                self.logger.warning(f"Could not parse release date: {release_date}")
+        fields.append(("releasedate", release_text))
+        
+        # Add developer, publisher and genre
+        fields.append(("developer", game_record.developer or ""))
+        fields.append(("publisher", game_record.publisher or ""))
+        fields.append(("genre", game_record.genres or ""))
+        
+        # Add players
+        if game_record.max_players:
+            min_text = game_record.min_players or "1"
+            fields.append(("players", f"{min_text}-{game_record.max_players}"))
+        else:
+            fields.append(("players", "1-1"))
+        
+        return fields
+    
+    def download_images(self, platform_folder, game_file, game_record, metadata, image_stem=None):
+        # Create images directory if it doesn't exist
+        images_dir = platform_folder / "images"
+        image_base = images_dir / (image_stem or game_file.stem)
+        # A ROM in a subfolder gets its artwork in the same subfolder of images/
+        image_base.parent.mkdir(parents=True, exist_ok=True)
+        
+        # Get database ID
+        db_id = game_record.database_id
+        if db_id is None:
+            self.logger.warning(f"No DatabaseID found for {game_file.name}")
+            return
+        
+        # Find image entries in metadata
+        with self.metrics.stage("image_lookup"):
+            artwork = metadata.artwork_for_game(db_id)
+        
+        for image_type, suffix in ARTWORK_TYPES:
+            # Find the image entry in metadata
+            image_info = None
+            if suffix in artwork:
+                type_text, image_info = artwork[suffix]
+                # For screenshots, any type containing "Screenshot" is used if there is no gameplay one
+                if type_text != image_type:
+                    self.log(f"  Using alternative screenshot: {type_text}")
+                    self.logger.info(f"Using alternative screenshot for {game_file.name}: {type_text}")
+            
+            if image_info:
+                # Download image
+                url = f"{IMAGE_BASE_URL}{image_info}"
+                image_path = image_base.parent / f"{image_base.name}-{suffix}.png"
+                
+                # Check if image already exists
+                if image_path.exists():
+                    self.logger.info(f"Image already exists: {image_path}")
+                    self.metrics.inc("images_existing")
+                    continue
+                
+                key = ArtworkCache.key(image_info, DEVICE_PROFILES[self.device_profile].get(suffix))
+                self.fetch_image(url, image_path, suffix, key)
+            else:
+                self.logger.warning(f"No {image_type} image found for {game_file.name}")
+    
+    def fetch_image(self, url, image_path, suffix, key):
+        """Put an image at image_path, from the artwork cache or else through the download queue
+        
+        Returns True if the image came from the cache.
+        """
+        if self.artwork_cache is not None:
+            cached = self.artwork_cache.place(key, image_path)
+            self.metrics.inc("cache_requests", cache="artwork", result="hit" if cached else "miss")
+            if cached:
+                self.log(f"  Using cached {suffix} image")
+                self.logger.info(f"Using cached {suffix} image {url} for: {image_path}")
+                return True
+        
+        if self.download_queue is not None:
+            self.download_queue.add(image_path, url, suffix, key)
+        
+        # Another game (a second folder of the same platform, another disc)
+        # is already downloading this image, take a copy once it's done
+        with self.artwork_lock:
+            waiting = self.artwork_waiting.get(key)
+            if waiting is not None:
+                waiting.append((suffix, image_path))
+                self.metrics.inc("images_shared")
+                return False
+            self.artwork_waiting[key] = []
+        
+        self.logger.info(f"Downloading {suffix} image from: {url}")
+        process = functools.partial(self.process_image, suffix)
+        if self.downloader.submit(url, image_path, process, self.download_finished(suffix, image_path, key),
+                                  ARTWORK_PRIORITY.get(suffix, 0)) is None:
+            self.share_artwork(key, None)
+        return False
+    
+    def resume_downloads(self):
+        """Queue again the image downloads earlier scans left unfinished
+        
+        Jobs whose image is already in place, and decodes, are dropped. Other
+        images, and temporary files that interrupted downloads left behind,
+        are deleted and fetched again.
+        """
+        jobs = self.download_queue.jobs()
+        if not jobs:
+            return
+        
+        folder_names = {}  # images folder -> names of the files in it
+        resumed = 0
+        for image_path, url, suffix, key in jobs:
+            if image_path.parent not in folder_names:
+                try:
+                    folder_names[image_path.parent] = set(os.listdir(image_path.parent))
+                except OSError:
+                    # The drive may just not be mounted now, keep the job for later
+                    folder_names[image_path.parent] = None
+            names = folder_names[image_path.parent]
+            if names is None:
+                continue
+            
+            part_prefix = f".{image_path.name}."
+            for name in names:
+                if name.startswith(part_prefix) and name.endswith(".part"):
+                    try:
+                        os.unlink(image_path.parent / name)
+                        self.logger.info(f"Deleted partial download: {image_path.parent / name}")
+                    except OSError:
+                        pass
+            
+            if image_path.name in names:
+                if is_complete_image(image_path):
+                    self.download_queue.remove(image_path)
+                    continue
+                self.logger.warning(f"Deleting incomplete image: {image_path}")
+                try:
+                    image_path.unlink()
+                except OSError as e:
+                    self.logger.error(f"Error deleting image {image_path}: {str(e)}")
+                    continue
+            
+            if self.fetch_image(url, image_path, suffix, key):
+                self.download_queue.remove(image_path)
+            resumed += 1
+        
+        if resumed:
+            self.metrics.inc("downloads_resumed", resumed)
+            msg = f"Resuming {resumed} image downloads left unfinished by an earlier scan"
+            self.log(msg)
+            self.logger.info(msg)
+    
+    def download_finished(self, suffix, image_path, key):
+        """Return the callback that logs the outcome of one image download and shares the image
+        
+        The job stays in the download queue if the download was cancelled or
+        the network failed, so the next scan tries again.
+        """
+        def on_done(future):
+            try:
+                if future.result() is None:
+                    self.share_artwork(key, None)
+                    return
+                self.dequeue_download(image_path)
+                self.log(f"  Downloaded {suffix} image")
+                self.logger.info(f"Downloaded {suffix} image to: {image_path}")
+                self.share_artwork(key, image_path)
+            except DownloadError as e:
+                self.dequeue_download(image_path)
+                self.share_artwork(key, None, failed=True)
+                self.metrics.inc("download_failures")
+                msg = f"Failed to download {suffix} image: {str(e)}"
+                self.log(msg)
+                self.logger.warning(msg)
+            except requests.RequestException as e:
+                self.share_artwork(key, None)
+                self.metrics.inc("download_failures")
+                msg = f"Could not download {suffix} image ({str(e)}), it will be retried by the next scan"
+                self.log(msg)
+                self.logger.warning(msg)
+            except Exception as e:
+                self.dequeue_download(image_path)
+                self.share_artwork(key, None, failed=True)
+                self.metrics.inc("download_failures")
+                msg = f"Error downloading {suffix} image: {str(e)}"
+                self.log(msg)
+                self.logger.error(msg)
+        return on_done
+    
+    def dequeue_download(self, image_path):
+        if self.download_queue is not None:
+            try:
+                self.download_queue.remove(image_path)
+            except sqlite3.Error as e:
+                self.logger.warning(f"Could not update the download queue: {str(e)}")
+    
+    def share_artwork(self, key, image_path, failed=False):
+        """Add a downloaded image to the artwork cache and copy it to the games waiting for it
+        
+        image_path is None if the download failed or was cancelled. If it failed
+        for good, the jobs of the games waiting for it leave the download queue
+        too; otherwise they stay, and the next scan fetches them.
+        """
+        if image_path is not None and self.artwork_cache is not None:
+            try:
+                self.artwork_cache.add(key, image_path)
+            except OSError as e:
+                self.logger.warning(f"Could not add {image_path} to the artwork cache: {str(e)}")
+        
+        with self.artwork_lock:
+            waiting = self.artwork_waiting.pop(key, [])
+        if image_path is None:
+            if failed:
+                for _, waiting_path in waiting:
+                    self.dequeue_download(waiting_path)
+            return
+        
+        for suffix, waiting_path in waiting:
+            try:
+                link_or_copy(image_path, waiting_path)
+                self.dequeue_download(waiting_path)
+                self.logger.info(f"Copied {suffix} image to: {waiting_path}")
+            except OSError as e:
+                self.logger.error(f"Error copying {suffix} image to {waiting_path}: {str(e)}")
+    
+    def process_image(self, suffix, data):
+        """Convert a downloaded image to PNG, sized for the device profile
+        
+        Called on a download thread; the work itself runs on the image process pool.
+        """
+        max_size = DEVICE_PROFILES[self.device_profile].get(suffix)
+        with self.metrics.stage("image_convert"):
+            data, original_size, size = self.image_pool.submit(convert_image, data, max_size).result()
+        if size != original_size:
+            self.log(f"  Resized {suffix} image from {original_size[0]}x{original_size[1]} to {size[0]}x{size[1]}")
+            self.logger.info(f"Resized {suffix} image from {original_size[0]}x{original_size[1]} to {size[0]}x{size[1]}")
+        return data
+
+class GameOrganizerApp(ScanEngine):
+    """The desktop app
+    
+    customtkinter and tkinter are imported when the window is created rather
+    than at module level, so headless scans never load them.
+    
+    The scan runs on worker threads, which must not touch Tk. Their log lines and
+    status updates go into a queue that the Tk main loop drains in batches every
+    UI_POLL_MS, so a busy scan never waits on the UI. The activity log shows the
+    last MAX_LOG_LINES lines; the log file keeps everything.
+    """
+    
+    UI_POLL_MS = 100
+    MAX_LOG_LINES = 2000
+    
+    def __init__(self):
+        import customtkinter as ctk
+        super().__init__()
+        
+        # Configuration
+        ctk.set_appearance_mode("Dark")
+        ctk.set_default_color_theme("blue")
+        
+        self.window = ctk.CTk()
+        self.window.title("RetroScraper")
+        self.window.geometry("900x700")
+        
+        # Variables
+        self.scan_folder = ctk.StringVar()
+        self.progress_value = ctk.DoubleVar(value=0)
+        self.status_text = ctk.StringVar(value="Ready to scan")
+        self.platform_status = ctk.StringVar(value="No platform being scanned")
+        
+        # Events from the scan threads, drained by process_ui_events
+        self.ui_events = queue.Queue()
+        
+        # Create UI
+        self.create_widgets()
+        self.window.after(self.UI_POLL_MS, self.process_ui_events)
+    
+    def mainloop(self):
+        self.window.mainloop()
+    
+    def process_ui_events(self):
+        """Apply everything queued since the last poll, then poll again"""
+        from tkinter import messagebox
+        lines = deque(maxlen=self.MAX_LOG_LINES)
+        latest = {}
+        errors = []
+        finished = None
+        
+        while True:
+            try:
+                event, value = self.ui_events.get_nowait()
+            except queue.Empty:
+                break
+            if event == "log":
+                lines.append(value)
+            elif event == "finished":
+                finished = value
+            elif event == "error":
+                errors.append(value)
+            else:
+                # Only the newest status/progress is worth drawing
+                latest[event] = value
+        
+        if lines:
+            self.log_text.insert("end", "\n".join(lines) + "\n")
+            # Trim the oldest lines beyond MAX_LOG_LINES
+            line_count = int(self.log_text.index("end-1c").split(".")[0]) - 1
+            if line_count > self.MAX_LOG_LINES:
+                self.log_text.delete("1.0", f"{line_count - self.MAX_LOG_LINES + 1}.0")
+            self.log_text.see("end")
+        
+        if "status" in latest:
+            self.status_text.set(latest["status"])
+        if "platform" in latest:
+            self.platform_status.set(latest["platform"])
+        if "progress" in latest:
+            self.progress_value.set(latest["progress"])
         
-        # Setup logging
-        self.setup_logging()
+        for error_message in errors:
+            messagebox.showerror("Error", error_message)
         
-        # Create UI
-        self.create_widgets()
+        if finished is not None:
+            completed, error = finished
+            if completed:
+                messagebox.showinfo("Success", "Scan completed successfully")
+            elif error is not None:
+                messagebox.showerror("Error", f"An error occurred during scanning: {str(error)}")
         
-        # Set metadata path
-        self.metadata_path = Path(__file__).parent / "Metadata.xml"
-        
-    def setup_logging(self):
-        # Create logs directory if it doesn't exist
-        log_dir = Path(__file__).parent / "logs"
-        log_dir.mkdir(exist_ok=True)
-        
-        # Create log file with timestamp
-        log_file = log_dir / f"log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        
-        # Configure logging
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_file, encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
-        self.logger = logging.getLogger(__name__)
-        self.logger.info("Application started")
+        self.window.after(self.UI_POLL_MS, self.process_ui_events)
     
     def create_widgets(self):
+        import customtkinter as ctk
+        
         # Main frame
-        main_frame = ctk.CTkFrame(self)
+        main_frame = ctk.CTkFrame(self.window)
         main_frame.pack(fill="both", expand=True, padx=20, pady=20)
         
         # Title
@@ -156,602 +3534,238 @@ class GameOrganizerApp(ctk.CTk):
         self.log_text = ctk.CTkTextbox(log_frame)
         self.log_text.pack(fill="both", expand=True, padx=10, pady=(0, 10))
     
-    def check_metadata(self):
-        """Check if metadata file exists, download if needed"""
-        if self.metadata_path.exists():
-            self.log("Metadata.xml found")
-            self.logger.info("Metadata.xml found")
-            return True
-        
-        self.log("Downloading metadata...")
-        self.logger.info("Metadata.xml not found, downloading...")
-        
-        try:
-            # Download metadata zip
-            url = "https://gamesdb.launchbox-app.com/Metadata.zip"
-            response = requests.get(url, timeout=60)
-            response.raise_for_status()
-            
-            # Extract only Metadata.xml
-            with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
-                with zip_file.open("Metadata.xml") as source, open(self.metadata_path, "wb") as target:
-                    shutil.copyfileobj(source, target)
-            
-            self.log("Metadata.xml downloaded successfully")
-            self.logger.info("Metadata.xml downloaded successfully")
-            return True
-            
-        except Exception as e:
-            error_msg = f"Failed to download metadata: {str(e)}"
-            self.log(error_msg)
-            self.logger.error(error_msg)
-            return False
-    
     def browse_scan_folder(self):
+        from tkinter import filedialog
         folder = filedialog.askdirectory(title="Select Games Folder")
         if folder:
             self.scan_folder.set(folder)
             self.logger.info(f"Selected games folder: {folder}")
     
     def start_scan(self):
+        from tkinter import messagebox
         if not self.scan_folder.get():
             messagebox.showerror("Error", "Please select a games folder to scan")
             return
         
-        # Check for metadata file
-        if not self.check_metadata():
-            messagebox.showerror("Error", "Metadata file not found and could not be downloaded")
-            return
-        
+        self.scan_path = Path(self.scan_folder.get())
         self.scanning = True
-        self.progress_value.set(0)
-        self.status_text.set("Scanning...")
-        self.platform_status.set("No platform being scanned")
+        self.set_progress(0)
+        self.set_status("Scanning...")
+        self.set_platform_status("No platform being scanned")
         self.log_text.delete("1.0", "end")
         self.log("Starting scan...")
         
         # Run scan in a separate thread to keep UI responsive
-        thread = threading.Thread(target=self.run_scan)
+        thread = threading.Thread(target=self.run_scan_in_background)
         thread.daemon = True
         thread.start()
     
     def cancel_scan(self):
         self.scanning = False
-        self.status_text.set("Scan cancelled")
-        self.platform_status.set("Scan cancelled")
+        self.cancel_downloads()
+        self.set_status("Scan cancelled")
+        self.set_platform_status("Scan cancelled")
         self.log("Scan was cancelled by user")
         self.logger.warning("Scan cancelled by user")
     
+    def run_scan_in_background(self):
+        # Checking for a newer Metadata.xml can mean a long download, so it
+        # runs here too, its progress shown through the UI event queue
+        if not self.check_metadata():
+            self.scanning = False
+            self.set_status("Metadata not available")
+            self.ui_events.put(("error", "Metadata file not found and could not be downloaded"))
+            return
+        completed = self.run_scan()
+        self.ui_events.put(("finished", (completed, self.scan_error)))
+    
+    # These are called from the scan threads, see process_ui_events
+    
     def log(self, message):
-        self.log_text.insert("end", message + "\n")
-        self.log_text.see("end")
-        self.update_idletasks()
+        self.ui_events.put(("log", message))
     
-    def run_scan(self):
-        try:
-            # Load metadata
-            self.log("Loading metadata file...")
-            self.logger.info("Loading metadata file")
-            metadata_tree = ET.parse(self.metadata_path)
-            metadata_root = metadata_tree.getroot()
-            
-            # Find all game files
-            self.log("Scanning for game files...")
-            self.logger.info("Scanning for game files")
-            
-            scan_path = Path(self.scan_folder.get())
-            
-            # Check if the selected folder is a platform folder itself
-            platform_name = scan_path.name.lower()
-            if platform_name in PLATFORM_MAPPING:
-                # User selected a platform folder directly
-                self.log(f"Scanning platform folder directly: {platform_name}")
-                self.logger.info(f"Scanning platform folder directly: {platform_name}")
-                
-                # Process this single platform folder
-                games_by_platform = {}
-                games = []
-                
-                for file in scan_path.iterdir():
-                    if file.is_file() and file.suffix.lower() in SCAN_EXTENSIONS:
-                        games.append(file)
-                
-                if games:
-                    games_by_platform[scan_path] = games
-                else:
-                    self.log("No game files found in the selected platform folder")
-                    self.logger.warning("No game files found in the selected platform folder")
-            else:
-                # User selected a folder containing platform subfolders
-                self.log("Scanning for platform subfolders...")
-                self.logger.info("Scanning for platform subfolders")
-                
-                game_files = []
-                platforms_found = set()
-                
-                for platform_folder in scan_path.iterdir():
-                    if platform_folder.is_dir():
-                        platform_name = platform_folder.name.lower()
-                        if platform_name in PLATFORM_MAPPING:
-                            platforms_found.add(platform_name)
-                            for file in platform_folder.iterdir():
-                                if file.is_file() and file.suffix.lower() in SCAN_EXTENSIONS:
-                                    game_files.append((platform_folder, file))
-                                    self.logger.debug(f"Found game file: {file.name} in {platform_name}")
-                
-                # Group games by platform folder
-                games_by_platform = {}
-                for platform_folder, game_file in game_files:
-                    if platform_folder not in games_by_platform:
-                        games_by_platform[platform_folder] = []
-                    games_by_platform[platform_folder].append(game_file)
-            
-            if not games_by_platform:
-                self.log("No platform folders or game files found")
-                self.logger.warning("No platform folders or game files found")
-                self.status_text.set("No platforms found")
-                return
-            
-            self.log(f"Found {sum(len(games) for games in games_by_platform.values())} game files across {len(games_by_platform)} platforms")
-            self.logger.info(f"Found {sum(len(games) for games in games_by_platform.values())} game files across {len(games_by_platform)} platforms")
-            
-            # Process each platform folder
-            processed_platforms = 0
-            total_platforms = len(games_by_platform)
-            
-            for platform_folder, games in games_by_platform.items():
-                if not self.scanning:
-                    break
-                
-                platform_name = platform_folder.name.lower()
-                platform_display_name = PLATFORM_MAPPING.get(platform_name, platform_name)
-                self.platform_status.set(f"Scanning: {platform_display_name}")
-                self.process_platform(platform_folder, games, metadata_root)
-                processed_platforms += 1
-                self.progress_value.set(processed_platforms / total_platforms)
-                self.status_text.set(f"Processing platforms... ({processed_platforms}/{total_platforms})")
-            
-            if self.scanning:
-                self.status_text.set("Scan completed successfully")
-                self.platform_status.set("Scan completed")
-                self.log("Scan completed successfully")
-                self.logger.info("Scan completed successfully")
-                messagebox.showinfo("Success", "Scan completed successfully")
-            else:
-                self.log("Scan was cancelled")
-                self.logger.warning("Scan was cancelled")
-                
-        except Exception as e:
-            error_msg = f"Error during scan: {str(e)}"
-            self.log(error_msg)
-            self.status_text.set("Error occurred")
-            self.platform_status.set("Error occurred")
-            self.logger.exception("Error during scan")
-            messagebox.showerror("Error", f"An error occurred during scanning: {str(e)}")
-        
-        self.scanning = False
+    def set_status(self, text):
+        self.ui_events.put(("status", text))
     
-    def process_platform(self, platform_folder, games, metadata_root):
-        """Process all games in a platform folder and update gamelist.xml once"""
-        platform_name = platform_folder.name.lower()
-        metadata_platform = PLATFORM_MAPPING.get(platform_name, "")
-        
-        if not metadata_platform:
-            msg = f"Skipping platform {platform_name}: No platform mapping found"
-            self.log(msg)
-            self.logger.warning(msg)
-            return
-        
-        # Load or create exclusion list
-        exclusion_file = platform_folder / "Excluded_From_Scan.txt"
-        excluded_files = self.load_exclusion_list(exclusion_file)
-        
-        # Load or create gamelist.xml
-        gamelist_path = platform_folder / "gamelist.xml"
-        backup_created = False
-        
-        if gamelist_path.exists():
-            try:
-                # Create backup only once per platform
-                backup_path = platform_folder / "gamelist.xml.bak"
-                if not backup_path.exists():
-                    shutil.copy2(gamelist_path, backup_path)
-                    backup_created = True
-                    self.logger.info(f"Created backup of gamelist.xml: {backup_path}")
-                
-                # Parse existing gamelist
-                tree = ET.parse(gamelist_path)
-                root = tree.getroot()
-                
-                # Remove XML declaration if it exists in the content
-                content = gamelist_path.read_text(encoding='utf-8')
-                if content.startswith('<?xml'):
-                    # Find the end of the XML declaration
-                    end_decl = content.find('?>') + 2
-                    content = content[end_decl:].lstrip()
-                
-                # Re-parse the content without the declaration
-                root = ET.fromstring(content)
-                
-            except ET.ParseError as e:
-                msg = f"Error parsing {gamelist_path}: {str(e)}. Creating a new one."
-                self.log(msg)
-                self.logger.warning(msg)
-                # If the XML is invalid, create a new root
-                root = ET.Element("gameList")
+    def set_platform_status(self, text):
+        self.ui_events.put(("platform", text))
+    
+    def set_progress(self, value):
+        self.ui_events.put(("progress", value))
+
+class ConsoleScanner(ScanEngine):
+    """Headless front end that prints progress to stdout, as text or JSON lines"""
+    
+    def __init__(self, scan_path, metadata_path=None, json_output=False):
+        super().__init__(scan_path, metadata_path)
+        self.json_output = json_output
+        self.cancelled = False
+        # Download callbacks log from worker threads
+        self.output_lock = threading.Lock()
+    
+    def emit(self, event, **fields):
+        if self.json_output:
+            line = json.dumps({"event": event, **fields})
+        elif event == "log":
+            line = fields["message"]
         else:
-            # Create new gamelist
-            root = ET.Element("gameList")
-            self.logger.info(f"Creating new gamelist.xml at {gamelist_path}")
-        
-        # Process each game in the platform folder
-        processed_games = 0
-        total_games = len(games)
-        
-        for game_file in games:
-            if not self.scanning:
-                break
-                
-            # Check if file is in exclusion list
-            if game_file.name in excluded_files:
-                msg = f"Skipping {game_file.name}: File is in exclusion list"
-                self.log(msg)
-                self.logger.info(msg)
-                continue
-                
-            processed = self.process_game(platform_folder, game_file, metadata_root, metadata_platform, root, exclusion_file, excluded_files)
-            if processed:
-                processed_games += 1
-                
-            self.log(f"Processed {processed_games}/{total_games} games in {platform_name}")
-        
-        # Only write to file if we found new games to add
-        if processed_games > 0:
-            # Write to file with proper formatting
-            rough_string = ET.tostring(root, 'utf-8')
-            reparsed = minidom.parseString(rough_string)
-            pretty_xml = reparsed.toprettyxml(indent="\t")
-            
-            # Remove extra lines added by minidom and the XML declaration
-            lines = pretty_xml.split('\n')
-            # Skip the first line (XML declaration) and any empty lines
-            lines = [line for line in lines[1:] if line.strip()]
-            
-            with open(gamelist_path, 'w', encoding='utf-8') as f:
-                f.write('<?xml version="1.0"?>\n')
-                for line in lines:
-                    f.write(line + '\n')
-            
-            self.logger.info(f"Updated gamelist.xml for {platform_name} with {processed_games} new games")
-            self.log(f"Updated gamelist.xml for {platform_name} with {processed_games} new games")
+            return
+        with self.output_lock:
+            print(line, flush=True)
     
-    def load_exclusion_list(self, exclusion_file):
-        """Load the list of excluded files from the exclusion file"""
-        excluded_files = set()
-        
-        if exclusion_file.exists():
-            try:
-                with open(exclusion_file, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        filename = line.strip()
-                        if filename:  # Skip empty lines
-                            excluded_files.add(filename)
-                self.logger.info(f"Loaded {len(excluded_files)} files from exclusion list: {exclusion_file}")
-            except Exception as e:
-                self.logger.error(f"Error reading exclusion file {exclusion_file}: {str(e)}")
-        
-        return excluded_files
+    def log(self, message):
+        self.emit("log", message=message)
     
-    def add_to_exclusion_list(self, exclusion_file, filename):
-        """Add a filename to the exclusion list"""
-        try:
-            with open(exclusion_file, 'a', encoding='utf-8') as f:
-                f.write(f"{filename}\n")
-            self.logger.info(f"Added {filename} to exclusion list: {exclusion_file}")
-            return True
-        except Exception as e:
-            self.logger.error(f"Error adding {filename} to exclusion file {exclusion_file}: {str(e)}")
-            return False
+    def set_status(self, text):
+        self.emit("status", status=text)
     
-    def process_game(self, platform_folder, game_file, metadata_root, metadata_platform, root, exclusion_file, excluded_files):
-        """Process a single game and add it to the XML root if not already present"""
-        # Check if game already exists in the XML
-        for game_elem in root.findall("game"):
-            path_elem = game_elem.find("path")
-            if path_elem is not None and path_elem.text == f"./{game_file.name}":
-                msg = f"Skipping {game_file.name}: Already exists in gamelist.xml"
-                self.log(msg)
-                self.logger.info(msg)
-                return False
-        
-        # Find matching game in metadata
-        game_name_no_ext = self.clean_game_name(game_file.stem)
-        best_match = None
-        best_score = 0
-        exact_match = False
-        
-        for game_elem in metadata_root.findall("Game"):
-            name_elem = game_elem.find("Name")
-            platform_elem = game_elem.find("Platform")
-            
-            if (name_elem is not None and name_elem.text and 
-                platform_elem is not None and platform_elem.text == metadata_platform):
-                
-                metadata_name = self.clean_game_name(name_elem.text)
-                
-                # First try exact match
-                if game_name_no_ext.lower() == metadata_name.lower():
-                    best_match = game_elem
-                    exact_match = True
-                    break
-                
-                # Calculate similarity score if no exact match
-                score = self.similarity(game_name_no_ext.lower(), metadata_name.lower())
-                if score > best_score and score > 0.7:  # Higher threshold for matching
-                    best_score = score
-                    best_match = game_elem
-        
-        if best_match is None:
-            msg = f"No metadata found for {game_file.name} (cleaned: {game_name_no_ext}) on platform {metadata_platform}"
-            self.log(msg)
-            self.logger.info(msg)
-            
-            # Add to exclusion list
-            if game_file.name not in excluded_files:
-                if self.add_to_exclusion_list(exclusion_file, game_file.name):
-                    excluded_files.add(game_file.name)
-                    self.log(f"Added {game_file.name} to exclusion list")
-            
-            return False
-        
-        match_type = "exact" if exact_match else f"fuzzy (score: {best_score:.2f})"
-        msg = f"Processing {game_file.name} -> {best_match.find('Name').text} ({match_type})"
-        self.log(msg)
-        self.logger.info(msg)
-        
-        # Add game to XML
-        self.add_game_to_xml(root, game_file, best_match)
-        
-        # Download images
-        self.download_images(platform_folder, game_file, best_match, metadata_root)
-        
-        return True
+    def set_platform_status(self, text):
+        self.emit("platform", status=text)
     
-    def clean_game_name(self, name):
-        # Remove common tags and formatting from game names
-        patterns = [
-            r'\([^)]*\)',  # Remove anything in parentheses
-            r'\[[^\]]*\]',  # Remove anything in brackets
-            r'\.',          # Remove dots
-            r'\-',          # Remove hyphens
-            r'\_',          # Remove underscores
-            r'\s+',         # Replace multiple spaces with single space
-        ]
-        
-        cleaned = name
-        for pattern in patterns:
-            cleaned = re.sub(pattern, ' ', cleaned)
-        
-        # Remove common words that might differ between filename and metadata
-        common_words = ['usa', 'europe', 'japan', 'english', 'rev', 'version', 'disk', 'disc']
-        words = cleaned.split()
-        filtered_words = [word for word in words if word.lower() not in common_words]
-        
-        return ' '.join(filtered_words).strip()
-    
-    def similarity(self, a, b):
-        return SequenceMatcher(None, a, b).ratio()
-    
-    def add_game_to_xml(self, root, game_file, game_elem):
-        # Create game element
-        game = ET.SubElement(root, "game")
-        
-        # Add path
-        path_elem = ET.SubElement(game, "path")
-        path_elem.text = f"./{game_file.name}"
-        
-        # Add name
-        name_elem = ET.SubElement(game, "name")
-        name_text = game_elem.find("Name").text if game_elem.find("Name") is not None else ""
-        name_elem.text = name_text
-        
-        # Add description
-        desc_elem = ET.SubElement(game, "desc")
-        overview_elem = game_elem.find("Overview")
-        desc_text = overview_elem.text if overview_elem is not None else ""
-        # Clean up description text
-        desc_text = re.sub(r'\s+', ' ', desc_text).strip()
-        desc_elem.text = desc_text
-        
-        # Add image paths
-        image_base = f"./images/{game_file.stem}"
-        ET.SubElement(game, "image").text = f"{image_base}-image.png"
-        ET.SubElement(game, "marquee").text = f"{image_base}-marquee.png"
-        ET.SubElement(game, "thumbnail").text = f"{image_base}-thumbnail.png"
-        
-        # Add rating (convert from 0-5 scale to 0-1 scale)
-        rating_elem = ET.SubElement(game, "rating")
-        community_rating = game_elem.find("CommunityRating")
-        if community_rating is not None and community_rating.text:
-            try:
-                # Convert from 0-5 scale to 0-1 scale
-                rating = float(community_rating.text) / 5.0
-                rating_elem.text = f"{rating:.2f}"[:4]  # Format to 2 decimal places
-            except ValueError:
-                rating_elem.text = "0.00"
-                self.logger.warning(f"Invalid rating value: {community_rating.text}")
-        else:
-            rating_elem.text = "0.00"
-        
-        # Add release date
-        release_elem = ET.SubElement(game, "releasedate")
-        release_date = game_elem.find("ReleaseDate")
-        if release_date is not None and release_date.text:
-            # Extract date part only (YYYY-MM-DD)
-            date_match = re.search(r'(\d{4}-\d{2}-\d{2})', release_date.text)
-            if date_match:
-                date_str = date_match.group(1).replace("-", "")
-                release_elem.text = date_str + "T000000"
-            else:
-                self.logger.warning(f"Could not parse release date: {release_date.text}")
-                release_elem.text = ""
-        else:
-            release_elem.text = ""
-        
-        # Add developer
-        developer_elem = ET.SubElement(game, "developer")
-        developer = game_elem.find("Developer")
-        developer_elem.text = developer.text if developer is not None else ""
-        
-        # Add publisher
-        publisher_elem = ET.SubElement(game, "publisher")
-        publisher = game_elem.find("Publisher")
-        publisher_elem.text = publisher.text if publisher is not None else ""
-        
-        # Add genre
-        genre_elem = ET.SubElement(game, "genre")
-        genres = game_elem.find("Genres")
-        genre_elem.text = genres.text if genres is not None else ""
-        
-        # Add players
-        players_elem = ET.SubElement(game, "players")
-        max_players = game_elem.find("MaxPlayers")
-        if max_players is not None and max_players.text:
-            min_players = game_elem.find("MinPlayers")
-            min_text = min_players.text if min_players is not None else "1"
-            players_elem.text = f"{min_text}-{max_players.text}"
-        else:
-            players_elem.text = "1-1"
+    def set_progress(self, value):
+        self.emit("progress", progress=round(value, 4))
     
-    def download_images(self, platform_folder, game_file, game_elem, metadata_root):
-        # Create images directory if it doesn't exist
-        images_dir = platform_folder / "images"
-        images_dir.mkdir(exist_ok=True)
-        
-        # Get database ID
-        db_id_elem = game_elem.find("DatabaseID")
-        if db_id_elem is None:
-            self.logger.warning(f"No DatabaseID found for {game_file.name}")
-            return
-        
-        db_id = db_id_elem.text
-        
-        # Find image elements in metadata
-        image_types = [
-            ("Screenshot - Gameplay", "image"),
-            ("Clear Logo", "marquee"),
-            ("Box - Front", "thumbnail")
-        ]
-        
-        for image_type, suffix in image_types:
-            # Find the image entry in metadata
-            image_info = None
-            
-            # For screenshots, if the exact type isn't found, look for any type containing "Screenshot"
-            if image_type == "Screenshot - Gameplay":
-                # First try exact match
-                for game_image in metadata_root.findall(".//GameImage"):
-                    type_elem = game_image.find("Type")
-                    db_id_elem_img = game_image.find("DatabaseID")
-                    
-                    if (type_elem is not None and type_elem.text == image_type and
-                        db_id_elem_img is not None and db_id_elem_img.text == db_id):
-                        
-                        file_name_elem = game_image.find("FileName")
-                        if file_name_elem is not None and file_name_elem.text:
-                            image_info = file_name_elem.text
-                            break
-                
-                # If exact match not found, look for any screenshot
-                if image_info is None:
-                    for game_image in metadata_root.findall(".//GameImage"):
-                        type_elem = game_image.find("Type")
-                        db_id_elem_img = game_image.find("DatabaseID")
-                        
-                        if (type_elem is not None and "Screenshot" in type_elem.text and
-                            db_id_elem_img is not None and db_id_elem_img.text == db_id):
-                            
-                            file_name_elem = game_image.find("FileName")
-                            if file_name_elem is not None and file_name_elem.text:
-                                image_info = file_name_elem.text
-                                self.log(f"  Using alternative screenshot: {type_elem.text}")
-                                self.logger.info(f"Using alternative screenshot for {game_file.name}: {type_elem.text}")
-                                break
-            else:
-                # For other image types, use exact match
-                for game_image in metadata_root.findall(".//GameImage"):
-                    type_elem = game_image.find("Type")
-                    db_id_elem_img = game_image.find("DatabaseID")
-                    
-                    if (type_elem is not None and type_elem.text == image_type and
-                        db_id_elem_img is not None and db_id_elem_img.text == db_id):
-                        
-                        file_name_elem = game_image.find("FileName")
-                        if file_name_elem is not None and file_name_elem.text:
-                            image_info = file_name_elem.text
-                            break
-            
-            if image_info:
-                # Download image
-                url = f"https://images.launchbox-app.com/{image_info}"
-                image_path = images_dir / f"{game_file.stem}-{suffix}.png"
-                
-                try:
-                    # Check if image already exists
-                    if image_path.exists():
-                        self.logger.info(f"Image already exists: {image_path}")
-                        continue
-                    
-                    self.logger.info(f"Downloading {suffix} image from: {url}")
-                    response = requests.get(url, stream=True, timeout=30)
-                    if response.status_code == 200:
-                        with open(image_path, 'wb') as out_file:
-                            response.raw.decode_content = True
-                            shutil.copyfileobj(response.raw, out_file)
-                        
-                        # Resize marquee images if they are wider than 400px
-                        if suffix == "marquee":
-                            self.resize_marquee_image(image_path)
-                        
-                        self.log(f"  Downloaded {suffix} image")
-                        self.logger.info(f"Downloaded {suffix} image to: {image_path}")
-                    else:
-                        msg = f"Failed to download {suffix} image: HTTP {response.status_code}"
-                        self.log(msg)
-                        self.logger.warning(msg)
-                except Exception as e:
-                    msg = f"Error downloading {suffix} image: {str(e)}"
-                    self.log(msg)
-                    self.logger.error(msg)
-            else:
-                self.logger.warning(f"No {image_type} image found for {game_file.name}")
+    def cancel(self, signum=None, frame=None):
+        """Stop the scan after the current game; a second signal exits immediately"""
+        self.cancelled = True
+        self.scanning = False
+        self.cancel_downloads()
+        self.logger.warning("Scan cancelled by signal")
+        if signum is not None:
+            signal.signal(signum, signal.SIG_DFL)
+
+# Exit codes of a headless scan
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_METADATA = 3
+EXIT_CANCELLED = 130
+
+def run_headless(args):
+    setup_logging(console=False)
     
-    def resize_marquee_image(self, image_path):
-        """Resize marquee image if it's wider than 400px while maintaining aspect ratio"""
-        try:
-            with Image.open(image_path) as img:
-                width, height = img.size
-                
-                if width > 400:
-                    # Calculate new height while maintaining aspect ratio
-                    new_width = 400
-                    new_height = int((new_width / width) * height)
-                    
-                    # Resize the image
-                    resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-                    
-                    # Save the resized image
-                    resized_img.save(image_path, "PNG")
-                    
-                    self.log(f"  Resized marquee image from {width}x{height} to {new_width}x{new_height}")
-                    self.logger.info(f"Resized marquee image from {width}x{height} to {new_width}x{new_height}")
-                else:
-                    self.logger.info(f"Marquee image size is {width}x{height} (no resizing needed)")
-                    
-        except Exception as e:
-            self.logger.error(f"Error resizing marquee image {image_path}: {str(e)}")
+    scan_path = Path(args.scan_folder)
+    if not scan_path.is_dir():
+        print(f"Not a folder: {scan_path}", file=sys.stderr)
+        return EXIT_USAGE
+    
+    scanner = ConsoleScanner(scan_path, args.metadata, json_output=args.json)
+    scanner.refresh_existing = args.refresh
+    scanner.update_metadata = not args.no_update
+    scanner.use_match_cache = not args.no_match_cache
+    scanner.incremental = args.incremental
+    scanner.prune_removed = args.prune
+    scanner.generate_playlists = args.m3u
+    if args.depth is not None:
+        scanner.discovery_depth = args.depth
+    scanner.discovery_ignore = args.ignore
+    if args.discovery_workers is not None:
+        scanner.discovery_workers = args.discovery_workers
+    if args.match_workers is not None:
+        scanner.match_workers = args.match_workers
+    if args.download_workers is not None:
+        scanner.download_workers = args.download_workers
+    if args.downloads_per_host is not None:
+        scanner.downloads_per_host = args.downloads_per_host
+    if args.bandwidth_limit is not None:
+        scanner.download_bandwidth = args.bandwidth_limit * 1024
+    if args.dats is not None:
+        scanner.dat_path = Path(args.dats)
+    if args.hash_workers is not None:
+        scanner.hash_workers = args.hash_workers
+    if args.image_workers is not None:
+        scanner.image_workers = args.image_workers
+    if args.artwork_cache_size is not None:
+        scanner.artwork_cache_size = args.artwork_cache_size * 1024 * 1024
+    scanner.device_profile = args.device_profile
+    if args.metrics_textfile is not None:
+        scanner.metrics_textfile_path = Path(args.metrics_textfile)
+    scanner.watch = args.watch
+    scanner.watch_polling = args.poll
+    if args.watch_interval is not None:
+        scanner.watch_interval = args.watch_interval
+    if args.debounce is not None:
+        scanner.watch_debounce = args.debounce
+    
+    signal.signal(signal.SIGINT, scanner.cancel)
+    signal.signal(signal.SIGTERM, scanner.cancel)
+    
+    if not scanner.check_metadata():
+        exit_code = EXIT_NO_METADATA
+    else:
+        scanner.scanning = True
+        scanner.log("Starting scan...")
+        if scanner.run_scan():
+            exit_code = EXIT_OK
+        elif scanner.cancelled:
+            # Watch mode runs until it is stopped
+            exit_code = EXIT_OK if args.watch and scanner.scan_error is None else EXIT_CANCELLED
+        else:
+            exit_code = EXIT_FAILED
+        scanner.emit("summary", **scanner.metrics.summary())
+    
+    scanner.emit("done", success=exit_code == EXIT_OK, exit_code=exit_code)
+    return exit_code
 
-if __name__ == "__main__":
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Scrape LaunchBox metadata and artwork into EmulationStation gamelist.xml files. "
+                    "Without a folder, the desktop app is started.")
+    parser.add_argument("scan_folder", nargs="?",
+                        help="ROMs folder (or a single platform folder) to scan without the GUI")
+    parser.add_argument("--metadata", help="path to Metadata.xml (default: next to RetroScraper)")
+    parser.add_argument("--json", action="store_true", help="print progress as JSON lines")
+    parser.add_argument("--no-update", action="store_true", help="don't check for a newer Metadata.xml")
+    parser.add_argument("--refresh", action="store_true",
+                        help="update metadata of games already in gamelist.xml")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process ROMs added or changed since the last scan")
+    parser.add_argument("--prune", action="store_true",
+                        help="remove gamelist entries and images of deleted ROMs")
+    parser.add_argument("--m3u", action="store_true",
+                        help="write an .m3u playlist for multi-disc games and list it in gamelist.xml instead of the discs")
+    parser.add_argument("--depth", type=int, metavar="LEVELS",
+                        help="levels of subfolders of each platform folder searched for ROMs (default: 0)")
+    parser.add_argument("--ignore", action="append", default=[], metavar="PATTERN",
+                        help="skip files and folders whose name matches this wildcard pattern, can be repeated")
+    parser.add_argument("--watch", action="store_true",
+                        help="after the scan, keep watching the folder and scrape new ROMs as they are added, until stopped")
+    parser.add_argument("--poll", action="store_true",
+                        help="in watch mode, list the folders periodically instead of using inotify, "
+                             "e.g. for network shares other machines write to")
+    parser.add_argument("--watch-interval", type=float, metavar="SECONDS",
+                        help="how often folders are listed when polling (default: 30)")
+    parser.add_argument("--debounce", type=float, metavar="SECONDS",
+                        help="in watch mode, wait until files have not changed for this long before scanning them (default: 2)")
+    parser.add_argument("--no-match-cache", action="store_true",
+                        help="match every game again instead of using matches remembered from earlier scans")
+    parser.add_argument("--dats", help="folder of No-Intro/Redump DAT files to identify ROMs by hash "
+                                       "(default: DATs next to Metadata.xml)")
+    parser.add_argument("--device-profile", choices=sorted(DEVICE_PROFILES), default=DEFAULT_DEVICE_PROFILE,
+                        help="screen size the artwork is scaled down for (default: only limit marquees to 400px wide)")
+    parser.add_argument("--artwork-cache-size", type=int, metavar="MB",
+                        help="size of the artwork cache shared by all libraries, 0 disables it (default: 2048)")
+    parser.add_argument("--metrics-textfile", metavar="PATH",
+                        help="where to write scan metrics for Prometheus' textfile collector (default: logs/RetroScraper.prom)")
+    parser.add_argument("--discovery-workers", type=int, help="threads used to list ROM folders (default: 4)")
+    parser.add_argument("--match-workers", type=int, help="processes used to match games (default: one per CPU)")
+    parser.add_argument("--hash-workers", type=int, help="threads used to hash ROMs (default: 4)")
+    parser.add_argument("--image-workers", type=int, help="processes used to convert images (default: one per CPU)")
+    parser.add_argument("--download-workers", type=int, help="concurrent image downloads (default: 8)")
+    parser.add_argument("--downloads-per-host", type=int, help="concurrent downloads per server (default: 4)")
+    parser.add_argument("--bandwidth-limit", type=int, metavar="KB/S",
+                        help="cap the combined speed of image downloads, 0 for no limit (default: 0)")
+    args = parser.parse_args(argv)
+    
+    if args.scan_folder is not None:
+        return run_headless(args)
+    
+    setup_logging()
     app = GameOrganizerApp()
-
     app.mainloop()
+    return EXIT_OK
+
+if __name__ == "__main__":
+    # Needed for the match worker processes in frozen (PyInstaller) builds
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,393 @@
+"""Benchmark RetroScraper's scan stages on synthetic data
+
+Generates a Metadata.xml, ROM folders with realistic dirty file names and a
+local HTTP server standing in for the LaunchBox image host, then times each
+stage of a scan on its own: metadata load, clean_game_name, matching,
+image lookup, download and gamelist write, plus a full scan end to end.
+
+Results are written as JSON so runs from different versions can be diffed:
+
+    python benchmark.py --games 100000 --roms 5000 --output before.json
+"""
+
+import argparse
+import functools
+import http.server
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+from PIL import Image
+
+import RetroScraper as rs
+
+WORDS = ("super mario world zelda metroid chrono trigger final fantasy street fighter sonic hedgehog "
+         "mega man castlevania contra donkey kong kirby star fox pilot wings zero tetris pokemon "
+         "crystal dragon quest warrior ninja turtles legend quest racing soccer tennis golf puzzle "
+         "bomber adventure island double dragon gradius ghosts goblins metal slug king fighters "
+         "tekken ridge racer crash bandicoot spyro resident evil silent hill gran turismo").split()
+
+REGION_TAGS = ["(USA)", "(Europe)", "(Japan)", "(USA, Europe)", "(En,Fr,De)", "(World)"]
+EXTRA_TAGS = ["(Rev 1)", "(Rev A)", "(v1.1)", "[!]", "[b1]", "(Beta)", "(Proto)"]
+IMAGE_TYPES = ["Box - Front", "Clear Logo", "Screenshot - Gameplay", "Screenshot - Game Title",
+               "Fanart - Background", "Box - Back", "Banner"]
+
+# Folder names of the platforms games are spread over, one per LaunchBox platform
+PLATFORM_FOLDERS = {}
+for folder, platform_name in rs.PLATFORM_MAPPING.items():
+    if platform_name not in PLATFORM_FOLDERS.values() and folder.strip() == folder:
+        PLATFORM_FOLDERS[folder] = platform_name
+
+def random_title(rng):
+    title = " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 4)))
+    if rng.random() < 0.2:
+        title += ": " + " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 2)))
+    if rng.random() < 0.1:
+        title += f" {rng.randint(2, 4)}"
+    return title
+
+def generate_metadata(xml_path, games, platforms, images_per_game, seed):
+    """Write a Metadata.xml shaped like LaunchBox's; returns [(platform, name)] of its games"""
+    rng = random.Random(seed)
+    platform_names = list(PLATFORM_FOLDERS.values())[:platforms]
+    catalog = []
+    with open(xml_path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" standalone="yes"?>\n<LaunchBox>\n')
+        for database_id in range(1, games + 1):
+            name = random_title(rng)
+            platform_name = rng.choice(platform_names)
+            catalog.append((platform_name, name))
+            f.write(f"  <Game>\n"
+                    f"    <Name>{escape(name)}</Name>\n"
+                    f"    <ReleaseDate>{rng.randint(1980, 2010)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}T00:00:00-07:00</ReleaseDate>\n"
+                    f"    <Overview>{escape(name)} is a game.\n Lots of  text about it.</Overview>\n"
+                    f"    <MaxPlayers>{rng.randint(1, 4)}</MaxPlayers>\n"
+                    f"    <ReleaseType>Released</ReleaseType>\n"
+                    f"    <DatabaseID>{database_id}</DatabaseID>\n"
+                    f"    <Platform>{escape(platform_name)}</Platform>\n"
+                    f"    <CommunityRating>{rng.random() * 5:.3f}</CommunityRating>\n"
+                    f"    <Developer>Developer {database_id % 97}</Developer>\n"
+                    f"    <Publisher>Publisher {database_id % 53}</Publisher>\n"
+                    f"    <Genres>Action; Platform</Genres>\n"
+                    f"  </Game>\n")
+        for database_id in range(1, games + 1):
+            count = min(len(IMAGE_TYPES), max(0, round(rng.gauss(images_per_game, 1))))
+            for image_type in rng.sample(IMAGE_TYPES, count):
+                extension = rng.choice(["png", "jpg"])
+                f.write(f"  <GameImage>\n"
+                        f"    <DatabaseID>{database_id}</DatabaseID>\n"
+                        f"    <FileName>{database_id}-{image_type.replace(' ', '')}.{extension}</FileName>\n"
+                        f"    <Type>{image_type}</Type>\n"
+                        f"    <Region>North America</Region>\n"
+                        f"  </GameImage>\n")
+        for database_id in range(1, games + 1, 9):
+            f.write(f"  <GameAlternateName>\n"
+                    f"    <AlternateName>{escape(random_title(rng))}</AlternateName>\n"
+                    f"    <DatabaseID>{database_id}</DatabaseID>\n"
+                    f"    <Region>Japan</Region>\n"
+                    f"  </GameAlternateName>\n")
+        f.write("</LaunchBox>\n")
+    return catalog
+
+def dirty_name(rng, name):
+    """Turn a clean title into a file name the way real ROM sets name them"""
+    kind = rng.random()
+    if kind < 0.35:
+        dirty = f"{name.replace(':', ' -')} {rng.choice(REGION_TAGS)}"
+    elif kind < 0.55:
+        dirty = f"{name.replace(':', '')} {rng.choice(REGION_TAGS)} {rng.choice(EXTRA_TAGS)}"
+    elif kind < 0.7:
+        dirty = name.lower().replace(" ", "_").replace(":", "") + f"_{rng.choice(REGION_TAGS)}"
+    elif kind < 0.85:
+        # A typo fuzzy matching has to get past
+        position = rng.randrange(len(name))
+        dirty = name[:position] + rng.choice("aeiou") + name[position + 1:] + f" {rng.choice(REGION_TAGS)}"
+    else:
+        # Something that is not in the database at all
+        dirty = " ".join(rng.choice(WORDS) for _ in range(3)) + " (Homebrew)"
+    return dirty
+
+def generate_roms(roms_dir, catalog, roms, multi_disc, seed):
+    """Create empty ROM files in platform folders; returns {platform folder: [ROM paths]}"""
+    rng = random.Random(seed)
+    folders = {platform_name: folder for folder, platform_name in PLATFORM_FOLDERS.items()}
+    games_by_platform = {}
+    made = 0
+    while made < roms:
+        platform_name, name = rng.choice(catalog)
+        platform_folder = roms_dir / folders[platform_name]
+        platform_folder.mkdir(parents=True, exist_ok=True)
+        extension = rng.choice(sorted(rs.SCAN_EXTENSIONS))
+        base = dirty_name(rng, name)
+        if rng.random() < multi_disc:
+            discs = rng.randint(2, 4)
+            file_names = [f"{base} (Disc {disc} of {discs}){extension}" for disc in range(1, discs + 1)]
+        else:
+            file_names = [base + extension]
+        for file_name in file_names:
+            rom_path = platform_folder / file_name.replace("/", " ")
+            if rom_path.exists():
+                continue
+            rom_path.write_bytes(b"")
+            games_by_platform.setdefault(platform_folder, []).append(rom_path)
+            made += 1
+    return games_by_platform
+
+class ImageServer:
+    """Local stand-in for the LaunchBox image host
+    
+    Serves a generated PNG or JPEG (chosen by the requested extension) for any
+    path, optionally after a delay to mimic network latency.
+    """
+    
+    def __init__(self, latency=0.0, size=(1024, 768)):
+        images = {}
+        for extension, image_format in (("png", "PNG"), ("jpg", "JPEG")):
+            image = Image.new("RGB", size)
+            pixels = image.load()
+            for x in range(0, size[0], 4):
+                for y in range(0, size[1], 4):
+                    pixels[x, y] = (x % 256, y % 256, (x * y) % 256)
+            out = io.BytesIO()
+            image.save(out, image_format)
+            images[extension] = out.getvalue()
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def do_GET(self):
+                if latency:
+                    time.sleep(latency)
+                data = images["jpg" if self.path.endswith(".jpg") else "png"]
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Stopwatch:
+    """Collects the wall time of every run of every stage"""
+    
+    def __init__(self):
+        self.runs = {}
+        self.items = {}
+    
+    def time(self, stage, function, items=None):
+        start = time.perf_counter()
+        result = function()
+        self.runs.setdefault(stage, []).append(time.perf_counter() - start)
+        if items is not None:
+            self.items[stage] = items
+        return result
+    
+    def results(self):
+        stages = {}
+        for stage, runs in self.runs.items():
+            median = statistics.median(runs)
+            result = {"seconds": round(median, 6), "min": round(min(runs), 6), "runs": [round(run, 6) for run in runs]}
+            items = self.items.get(stage)
+            if items is not None:
+                result["items"] = items
+                result["per_second"] = round(items / median, 1) if median else None
+            stages[stage] = result
+        return stages
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_stages(args, work_dir, stopwatch, server):
+    xml_path = work_dir / "Metadata.xml"
+    db_path = work_dir / "Metadata.db"
+    games_by_platform = generate_roms(work_dir / "roms", args.catalog, args.roms, args.multi_disc, args.seed + 1)
+    rom_files = [rom for roms in games_by_platform.values() for rom in roms]
+    metadata_platforms = {platform_folder: rs.PLATFORM_MAPPING[platform_folder.name] for platform_folder in games_by_platform}
+    # The version the full scan will look for, so it reuses the index compiled here
+    metadata_version = rs.MetadataUpdater(xml_path).version()
+    
+    for repeat in range(args.repeat):
+        # Metadata load: compiling the SQLite index, and the XML fallback
+        if db_path.exists():
+            db_path.unlink()
+        stopwatch.time("metadata_compile", lambda: rs.MetadataIndex.compile(xml_path, db_path, metadata_version), args.games)
+        metadata = stopwatch.time("metadata_open", lambda: rs.MetadataIndex(db_path))
+        if not args.skip_xml:
+            stopwatch.time("metadata_load_xml", lambda: rs.XmlMetadata(xml_path).close(), args.games)
+        
+        # clean_game_name over every ROM file name
+        lookup_names = stopwatch.time(
+            "clean_game_name", lambda: [rs.clean_game_name(rom.stem).lower() for rom in rom_files], len(rom_files))
+        
+        # Matching, the way process_game does it
+        engine = rs.ScanEngine(metadata_path=xml_path)
+        engine.platform_indexes = {}
+        stopwatch.time("platform_index", lambda: [engine.get_platform_index(metadata, metadata_platform)
+                                                  for metadata_platform in set(metadata_platforms.values())])
+        
+        def match_all():
+            matches = []
+            for rom, lookup_name in zip(rom_files, lookup_names):
+                platform_index = engine.get_platform_index(metadata, metadata_platforms[rom.parent])
+                game, _, _ = platform_index.match(lookup_name)
+                if game is not None:
+                    matches.append((rom, game))
+            return matches
+        matches = stopwatch.time("match", match_all, len(rom_files))
+        
+        # Image lookup for every matched game
+        artwork = stopwatch.time(
+            "image_lookup", lambda: [(rom, metadata.artwork_for_game(game.database_id)) for rom, game in matches], len(matches))
+        
+        # Download and conversion of the first --downloads images, without the artwork cache
+        download_dir = work_dir / f"downloads-{repeat}"
+        download_dir.mkdir()
+        jobs = [(f"{server.url}{file_name}", download_dir / f"{index}-{suffix}.png", suffix)
+                for index, (rom, game_artwork) in enumerate(artwork)
+                for suffix, (_, file_name) in game_artwork.items()][:args.downloads]
+        
+        def download_all():
+            engine.image_pool = ProcessPoolExecutor(max_workers=args.image_workers, mp_context=rs.PROCESS_CONTEXT)
+            engine.downloader = rs.ImageDownloader(workers=args.download_workers, per_host_limit=args.download_workers)
+            try:
+                futures = [engine.downloader.submit(url, path, functools.partial(engine.process_image, suffix))
+                           for url, path, suffix in jobs]
+                for future in futures:
+                    future.result()
+            finally:
+                engine.downloader.close()
+                engine.image_pool.shutdown()
+        stopwatch.time("download", download_all, len(jobs))
+        
+        # gamelist.xml write of every matched game
+        root = ET.Element("gameList")
+        for rom, game in matches:
+            engine.add_game_to_xml(root, rom, game)
+        gamelist_path = work_dir / f"gamelist-{repeat}.xml"
+        stopwatch.time("gamelist_write", lambda: engine.write_gamelist(root, gamelist_path), len(matches))
+        metadata.close()
+        
+        # The whole scan, as the command line runs it
+        if not args.skip_scan:
+            for gamelist in (work_dir / "roms").rglob("gamelist.xml*"):
+                gamelist.unlink()
+            for excluded in (work_dir / "roms").rglob("Excluded_From_Scan.txt"):
+                excluded.unlink()
+            for snapshot in (work_dir / "roms").rglob(rs.SNAPSHOT_FILE):
+                snapshot.unlink()
+            for images_dir in (work_dir / "roms").glob("*/images"):
+                shutil.rmtree(images_dir)
+            scanner = rs.ScanEngine(work_dir / "roms", xml_path)
+            scanner.update_metadata = False
+            scanner.use_match_cache = False
+            scanner.artwork_cache_size = 0
+            scanner.match_workers = args.match_workers
+            scanner.image_workers = args.image_workers
+            scanner.download_workers = args.download_workers
+            # Not the repository's logs/, which real scans write to
+            scanner.metrics_summary_path = work_dir / f"scan-{repeat}.json"
+            scanner.metrics_textfile_path = work_dir / f"RetroScraper-{repeat}.prom"
+            scanner.scanning = True
+            completed = stopwatch.time("full_scan", scanner.run_scan, len(rom_files))
+            if not completed:
+                raise RuntimeError(f"Full scan failed: {scanner.scan_error}")
+    
+    return {"roms": len(rom_files), "matched": len(matches), "platforms": len(games_by_platform)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark RetroScraper's scan stages on synthetic data")
+    parser.add_argument("--games", type=int, default=20000, help="games in the synthetic Metadata.xml (default: 20000)")
+    parser.add_argument("--platforms", type=int, default=8,
+                        help=f"platforms the games are spread over (default: 8, at most {len(PLATFORM_FOLDERS)})")
+    parser.add_argument("--images-per-game", type=float, default=3.0, help="average GameImages per game (default: 3)")
+    parser.add_argument("--roms", type=int, default=2000, help="ROM files to generate (default: 2000)")
+    parser.add_argument("--multi-disc", type=float, default=0.05, help="share of games split over several discs (default: 0.05)")
+    parser.add_argument("--downloads", type=int, default=200, help="images fetched in the download stage (default: 200)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the image server waits before answering")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each stage; the median is reported (default: 3)")
+    parser.add_argument("--match-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--image-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-xml", action="store_true", help="don't time loading Metadata.xml without the index")
+    parser.add_argument("--skip-scan", action="store_true", help="don't time a full scan")
+    parser.add_argument("--workdir", help="keep the generated files in this folder instead of a temporary one")
+    parser.add_argument("--output", help="write the JSON results here instead of to stdout")
+    args = parser.parse_args(argv)
+    args.platforms = max(1, min(args.platforms, len(PLATFORM_FOLDERS)))
+    
+    # Keep the scan's own logging out of the results
+    logging.getLogger(rs.__name__).setLevel(logging.ERROR)
+    
+    with tempfile.TemporaryDirectory(prefix="retroscraper-bench-") as temp_dir:
+        work_dir = Path(args.workdir) if args.workdir else Path(temp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        
+        print(f"Generating {args.games} games and {args.roms} ROMs in {work_dir}...", file=sys.stderr)
+        start = time.perf_counter()
+        args.catalog = generate_metadata(work_dir / "Metadata.xml", args.games, args.platforms,
+                                         args.images_per_game, args.seed)
+        setup_seconds = time.perf_counter() - start
+        
+        server = ImageServer(latency=args.latency)
+        rs.IMAGE_BASE_URL = server.url
+        stopwatch = Stopwatch()
+        try:
+            counts = run_stages(args, work_dir, stopwatch, server)
+        finally:
+            server.close()
+    
+    results = {
+        "benchmark": "RetroScraper",
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("catalog", "output", "workdir")},
+        "counts": counts,
+        "setup_seconds": round(setup_seconds, 3),
+        "stages": stopwatch.results(),
+    }
+    
+    for stage, result in results["stages"].items():
+        rate = f"  ({result['per_second']}/s)" if result.get("per_second") else ""
+        print(f"{stage:>20}: {result['seconds']:9.3f}s{rate}", file=sys.stderr)
+    
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# RetroScraper is a single script at the repository root, not an installed package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
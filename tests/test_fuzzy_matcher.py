@@ -0,0 +1,70 @@
+"""FuzzyMatcher must pick exactly what scoring every candidate with difflib does"""
+
+import random
+
+import pytest
+
+import RetroScraper as rs
+
+WORDS = ["super", "mario", "world", "zelda", "link", "past", "metroid", "fusion", "kirby", "dream",
+         "land", "sonic", "hedgehog", "street", "fighter", "turbo", "final", "fantasy", "mega", "man",
+         "donkey", "kong", "country", "castlevania", "contra", "tetris", "pokemon", "red", "blue", "gold"]
+
+
+def reference_best_match(names, query, threshold=rs.MATCH_THRESHOLD):
+    """The plain loop FuzzyMatcher replaced: first candidate with the highest score above threshold"""
+    best_position = None
+    best_score = 0
+    for position, name in enumerate(names):
+        score = rs.similarity(query, name)
+        if score > best_score and score > threshold:
+            best_score = score
+            best_position = position
+    return best_position, best_score
+
+
+def random_name(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+
+def mangle(rng, name):
+    """A ROM-like variant of a name: dropped, swapped or extra characters"""
+    chars = list(name)
+    for _ in range(rng.randint(0, 4)):
+        edit = rng.random()
+        position = rng.randrange(len(chars) + 1)
+        if edit < 0.4 and position < len(chars):
+            del chars[position]
+        elif edit < 0.7 and position < len(chars) - 1:
+            chars[position], chars[position + 1] = chars[position + 1], chars[position]
+        else:
+            chars.insert(position, rng.choice("abcdefghijklmnopqrstuvwxyz 0123"))
+    return "".join(chars)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_best_match_equals_difflib_loop(seed):
+    rng = random.Random(seed)
+    # Duplicates check that ties go to the earlier candidate
+    names = [random_name(rng) for _ in range(rng.randint(1, 300))]
+    names += rng.sample(names, min(len(names), 10))
+    rng.shuffle(names)
+    matcher = rs.FuzzyMatcher(names)
+    
+    queries = [mangle(rng, rng.choice(names)) for _ in range(40)] + [random_name(rng) for _ in range(10)] + [""]
+    for query in queries:
+        position, score = matcher.best_match(query)
+        expected_position, expected_score = reference_best_match(names, query)
+        assert position == expected_position, query
+        if expected_position is not None:
+            assert score == expected_score, query
+
+
+@pytest.mark.parametrize("threshold", [0.3, 0.5, 0.9])
+def test_best_match_honours_threshold(threshold):
+    rng = random.Random(threshold)
+    names = [random_name(rng) for _ in range(100)]
+    matcher = rs.FuzzyMatcher(names)
+    for query in (mangle(rng, rng.choice(names)) for _ in range(30)):
+        position, _ = matcher.best_match(query, threshold)
+        assert position == reference_best_match(names, query, threshold)[0], query
@@ -0,0 +1,72 @@
+"""write_gamelist must produce byte for byte what the old minidom pretty printer did"""
+
+import random
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from xml.dom import minidom
+
+import pytest
+
+import RetroScraper as rs
+
+# Characters that need escaping, whitespace minidom drops or keeps, and non-ASCII text
+ALPHABET = ["a", "b", " ", "\n", "\t", "&", "<", ">", '"', "'", "é", "日", "\r", "\r\n", "  \n  ", "x"]
+
+
+def reference_write_gamelist(root, gamelist_path):
+    """The writer write_gamelist replaced: a minidom round trip with blank lines dropped"""
+    pretty_xml = minidom.parseString(ET.tostring(root, 'utf-8')).toprettyxml(indent="\t")
+    lines = [line for line in pretty_xml.split('\n')[1:] if line.strip()]
+    with open(gamelist_path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n')
+        for line in lines:
+            f.write(line + '\n')
+
+
+def random_text(rng):
+    if rng.random() < 0.2:
+        return rng.choice(["", None])
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 8)))
+
+
+def random_element(rng, depth=0):
+    elem = ET.Element(rng.choice(["game", "path", "name", "desc", "folder"]))
+    for _ in range(rng.randint(0, 2)):
+        elem.set(rng.choice(["id", "source", "x"]), random_text(rng) or "v")
+    elem.text = random_text(rng)
+    if depth < 3:
+        for _ in range(rng.randint(0, 3)):
+            child = random_element(rng, depth + 1)
+            child.tail = random_text(rng)
+            elem.append(child)
+    return elem
+
+
+def typical_gamelist():
+    root = ET.Element("gameList")
+    engine = rs.ScanEngine()
+    record = rs.GameRecord(name="Chrono Trigger", database_id="1", platform="Super Nintendo Entertainment System",
+                           overview="A & B <travel>\nthrough time", release_date="1995-03-11T00:00:00-08:00",
+                           community_rating="4.5", developer="Square", publisher="Square", genres="Role-Playing",
+                           max_players="1")
+    engine.add_game_to_xml(root, Path("Chrono Trigger (USA).sfc"), record)
+    return root
+
+
+@pytest.mark.parametrize("seed", range(25))
+def test_matches_minidom_on_random_trees(seed, tmp_path):
+    rng = random.Random(seed)
+    engine = rs.ScanEngine()
+    for _ in range(20):
+        root = random_element(rng)
+        root.tag = "gameList"
+        reference_write_gamelist(root, tmp_path / "reference.xml")
+        engine.write_gamelist(root, tmp_path / "gamelist.xml")
+        assert (tmp_path / "gamelist.xml").read_bytes() == (tmp_path / "reference.xml").read_bytes(), ET.tostring(root)
+
+
+def test_matches_minidom_on_scraped_entry(tmp_path):
+    root = typical_gamelist()
+    reference_write_gamelist(root, tmp_path / "reference.xml")
+    rs.ScanEngine().write_gamelist(root, tmp_path / "gamelist.xml")
+    assert (tmp_path / "gamelist.xml").read_bytes() == (tmp_path / "reference.xml").read_bytes()